@@ -0,0 +1,89 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import os
+import sys
+import time
+from tools import tools
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from cfs_forecasts import member_encoding
+
+#########################################################
+# Compare encodings for climate forecast members. For each one this
+# reports the write time, file size, and read time for the two ways
+# members get read: the entire array at once (predict_phenology_from_climate)
+# and full time series for blocks of pixels (the hindcast scripts).
+#
+# Usage:
+#   python automated_forecasting/climate/benchmark_member_encoding.py [member_file]
+#
+# Without a member file a synthetic one the size of a full member is used.
+#########################################################
+
+encodings_to_test = {'float64 uncompressed':None,
+                     'float32 complevel 1': {'dtype':'float32', 'complevel':1, 'chunk_lat':50, 'chunk_lon':50},
+                     'int16 complevel 1':   {'dtype':'int16',   'complevel':1, 'chunk_lat':50, 'chunk_lon':50},
+                     'int16 complevel 4':   {'dtype':'int16',   'complevel':4, 'chunk_lat':50, 'chunk_lon':50},
+                     'int16 complevel 1 200x200':{'dtype':'int16', 'complevel':1, 'chunk_lat':200, 'chunk_lon':200}}
+
+read_block_size = 200
+
+def synthetic_member(land_mask, n_days=250):
+    # A seasonal cycle plus noise, nan outside of land
+    days = pd.date_range('2018-02-16', periods=n_days)
+    seasonal = 15 - 15*np.cos(2*np.pi*np.arange(n_days)/365)
+    values = seasonal[:,None,None] + np.random.normal(0, 3, (n_days, len(land_mask.lat), len(land_mask.lon)))
+    values[:, ~land_mask.land.values] = np.nan
+    return xr.Dataset({'tmean':(('time','lat','lon'), values)},
+                      coords = {'time':days, 'lat':land_mask.lat, 'lon':land_mask.lon})
+
+def read_blocks(filename):
+    with xr.open_dataset(filename) as member:
+        for lat_i in range(0, len(member.lat), read_block_size):
+            for lon_i in range(0, len(member.lon), read_block_size):
+                member.tmean[:, lat_i:lat_i+read_block_size, lon_i:lon_i+read_block_size].values
+
+def read_all(filename):
+    with xr.open_dataset(filename) as member:
+        member.tmean.values
+
+def timed(f, *args, **kwargs):
+    start_time = time.time()
+    f(*args, **kwargs)
+    return round(time.time() - start_time, 2)
+
+if __name__ == '__main__':
+    config = tools.load_config()
+
+    if len(sys.argv) > 1:
+        member = xr.open_dataset(sys.argv[1])[['tmean']].load()
+    else:
+        member = synthetic_member(xr.open_dataset(config['mask_file']))
+
+    results = []
+    for encoding_name, encoding_info in encodings_to_test.items():
+        filename = config['tmp_folder'] + 'member_encoding_benchmark.nc'
+        if encoding_info is None:
+            encoding = {'tmean':{'dtype':'float64'}}
+        else:
+            encoding = member_encoding(member, encoding_info)
+
+        write_time = timed(member.to_netcdf, filename, encoding=encoding)
+        file_size = os.path.getsize(filename)
+        read_all_time = timed(read_all, filename)
+        read_blocks_time = timed(read_blocks, filename)
+
+        with xr.open_dataset(filename) as written:
+            max_error = float(np.nanmax(np.abs(written.tmean.values - member.tmean.values)))
+
+        results.append({'encoding':encoding_name,
+                        'write_sec':write_time,
+                        'size_mb':round(file_size / 1024**2, 1),
+                        'read_all_sec':read_all_time,
+                        'read_all_mb_per_sec':round(member.tmean.nbytes / 1024**2 / max(read_all_time, 0.01), 1),
+                        'read_blocks_sec':read_blocks_time,
+                        'max_error':round(max_error, 4)})
+        os.remove(filename)
+
+    print(pd.DataFrame(results).to_string(index=False))
@@ -2,62 +2,371 @@ import xarray as xr
 import pandas as pd
 import numpy as np
 import os
+import glob
+import json
+import time
+import hashlib
+import shutil
+import tempfile
+import contextlib
+import threading
+import multiprocessing
+from concurrent import futures
 from tools import cfs_tools
-from tools import tools
+from tools import tools, tracing, grib_inventory, raw_file_cache, listing_cache
 import datetime
 
 
-def broadcast_downscale_model(model, start_date, end_date, verbose=True):
-    """The downscaling model netcdf has, for every pixel and
-    every calendar month, a slope and intercept to apply to 
-    downscale with. This broadcasts it to a full date range
-    to make for very easy application of it.
+def queue_forecast_downloads(manager, forecasts, downloads, n, first_forecast_day, 
+                             last_forecast_day, tmp_folder, partial_download=False,
+                             is_cached=lambda initial_time: False):
+    """Make sure the next n usable forecasts are downloading. Nothing past
+    those is started, which limits how many raw files are on disk at once.
+    
+    downloads is a dictionary of initial_time:{varname:download job} which 
+    is updated in place. Every variable in variables_to_use is downloaded.
+    
+    partial_download
+        Only get the grib messages for first_forecast_day to 
+        last_forecast_day, see grib_inventory.partial_transfer()
+    
+    is_cached
+        function(initial_time string) which is True if the member is
+        already processed. Those are not downloaded.
+    """
+    for forecast_info in forecasts:
+        if n == 0:
+            break
+        initial_time = tools.string_to_date(forecast_info['initial_time'], h=True)
+        if initial_time.date() > first_forecast_day.date():
+            continue
+        if forecast_info['initial_time'] in downloads:
+            pass
+        elif is_cached(forecast_info['initial_time']):
+            downloads[forecast_info['initial_time']] = {}
+        else:
+            variable_jobs = {}
+            for varname, download_url in forecast_info['download_urls'].items():
+                local_filename = tmp_folder + os.path.basename(download_url)
+                if partial_download:
+                    transfer = grib_inventory.partial_transfer(manager,
+                                                               initial_time = initial_time,
+                                                               first_day = first_forecast_day,
+                                                               last_day = last_forecast_day)
+                else:
+                    transfer = None
+                variable_jobs[varname] = manager.submit(download_url,
+                                                        local_filename,
+                                                        transfer = transfer)
+            downloads[forecast_info['initial_time']] = variable_jobs
+        n -= 1
+
+# Everything a member needs which is the same for all members. Set once
+# per worker by _init_member_worker().
+_member_state = {}
+
+def _init_member_worker(state, workers_tmp_folder=None):
+    _member_state.update(state)
+    
+    # Workers get their own temp folder so any scratch files from the
+    # netcdf/grib libraries don't collide.
+    if workers_tmp_folder:
+        worker_tmp_folder = workers_tmp_folder + 'worker_{pid}/'.format(pid=os.getpid())
+        tools.make_folder(worker_tmp_folder)
+        os.environ['TMPDIR'] = worker_tmp_folder
+        tempfile.tempdir = None
+
+##########################################
+# Downscaled forecast members are kept between runs, since most of the
+# members from one day are still among the most recent ones the next. 
+# They cover the full forecast range so they can be used for any 
+# first/last forecast day. A new downscaling model, land mask, or set of 
+# variables gives a new model version, so old members are not reused.
+
+def downscale_model_version(config):
+    version = hashlib.sha256()
+    version.update(raw_file_cache.file_sha256(config['downscaling_model_coefficients_file']).encode())
+    version.update(raw_file_cache.file_sha256(config['mask_file']).encode())
+    version.update(json.dumps(sorted(config['variables_to_use'])).encode())
+    version.update(b'distance_weighted_k2')
+    return version.hexdigest()[:16]
+
+def cached_member_filename(cache_folder, initial_time, model_version):
+    return cache_folder + 'cfsv2_{t}_{v}.nc'.format(t=initial_time, v=model_version)
+
+def _as_day(d):
+    return np.datetime64(pd.Timestamp(d).date())
+
+def member_covers_days(forecast_obj, first_day, last_day):
+    """True if a member starts on or before first_day and ends on or after
+    last_day. Only the dates are compared, any time of day is ignored.
     """
+    member_days = forecast_obj.time.values.astype('datetime64[D]')
+    return len(member_days) > 0 and member_days[0] <= _as_day(first_day) and member_days[-1] >= _as_day(last_day)
+
+def cached_member_usable(cache_filename, first_day, last_day):
+    """True if the cached member exists and covers first_day to last_day.
+    A shorter one (ie. from a run with a shorter lead time) is rebuilt.
+    """
+    if not os.path.exists(cache_filename):
+        return False
+    try:
+        with xr.open_dataset(cache_filename) as cached:
+            return member_covers_days(cached, first_day, last_day)
+    except (IOError, ValueError):
+        return False
+
+def evict_member_cache(cache_folder, max_age_days):
+    """Remove members not used in the last max_age_days"""
+    oldest_allowed = time.time() - max_age_days * 24 * 60 * 60
+    for f in glob.glob(cache_folder + 'cfsv2_*.nc'):
+        if os.path.getmtime(f) < oldest_allowed:
+            os.remove(f)
+
+def _downscale_member(forecast_info, local_filenames):
+    """The full range of a member, downscaled. Returns (status, forecast_obj
+    or message)
+    """
+    land_mask = _member_state['land_mask']
+    initial_time= tools.string_to_date(forecast_info['initial_time'], h=True)
+    
+    # The days and cells needed. The forecast end date is checked before
+    # anything is read, and only what's needed is read. 
+    plan = cfs_tools.MemberPlan(initial_time,
+                                first_day = _member_state['first_forecast_day'],
+                                last_day = _member_state['last_forecast_day'],
+                                keep_until = _member_state['keep_until'],
+                                target_array = land_mask.to_array()[0],
+                                method = 'distance_weighted',
+                                k = 2)
+    try:
+        # All variables are decoded and downscaled together
+        with tracing.span('grib_decode', initial_time=forecast_info['initial_time']):
+            forecast_obj = cfs_tools.convert_cfs_grib_forecast(local_filenames,
+                                                               add_initial_time_dim=False,
+                                                               date = initial_time,
+                                                               plan = plan)
+    except cfs_tools.ForecastRejected as e:
+        return 'skipped', 'Skipping due to ' + str(e)
+    except:
+        return 'error', 'processing error in converting'
     
-    # Note, need to make this pretty wide  to apply to ~10 forcasts
-    # with different lead times. Or do I? the forecats will already be
-    # cropped to the correct today - end_date, so no. 
-    date_range = pd.date_range(start_date, end_date)
-    model_broadcasted = model.sel(month = [date_range[0].month]).copy()
-    model_broadcasted = model_broadcasted.rename({'month':'time'})
-    model_broadcasted['time'] = [date_range[0]]
+    # ~1.0 deg cfs grid to 4km prism grid, along with the downscale 
+    # model for tmean, in a single pass.
+    try:
+        with tracing.span('spatial_downscale', initial_time=forecast_info['initial_time']):
+            forecast_obj = cfs_tools.remap_and_downscale(forecast_obj,
+                                                         target_array = land_mask.to_array()[0],
+                                                         model = _member_state['downscale_model'],
+                                                         method = 'distance_weighted',
+                                                         k = 2,
+                                                         data_var = 'tmean',
+                                                         time_dim = 'forecast_time')
+            forecast_obj = forecast_obj.rename({'forecast_time':'time'})
+    except:
+        return 'error', 'processing error in spatial downscale'
     
-    for count, date in enumerate(date_range[1:]):
-        day_broadcast = model.sel(month = [date.month]).copy()
-        day_broadcast = day_broadcast.rename({'month':'time'})
-        day_broadcast['time'] = [date]
-        model_broadcasted = xr.merge([model_broadcasted, day_broadcast]).copy()
-        if verbose and count % 10 == 0:
-            print('Broadcasting downscale model progress: {x} of {y}'.format(x=count,y=len(date_range)))
+    return 'ok', forecast_obj
+
+def member_encoding(forecast_obj, encoding_info):
+    """netcdf encoding for a climate member
     
-    return model_broadcasted
+    encoding_info
+        climate_member_encoding from the config file. dtype is float32,
+        or int16 with values scaled by 0.01. Chunks cover the full time
+        series of blocks of pixels, since predictions read entire time
+        series per pixel.
+    """
+    encoding = {}
+    for varname, data_array in forecast_obj.data_vars.items():
+        var_encoding = {'zlib':encoding_info['complevel'] > 0,
+                        'complevel':encoding_info['complevel']}
+        if encoding_info['dtype'] == 'int16':
+            var_encoding.update({'dtype':'int16', 'scale_factor':0.01, '_FillValue':-32768})
+        elif encoding_info['dtype'] == 'float32':
+            var_encoding.update({'dtype':'float32'})
+        else:
+            raise ValueError('unknown member dtype: ' + str(encoding_info['dtype']))
+        
+        chunk_sizes = {'time':len(forecast_obj.time),
+                       'lat':encoding_info['chunk_lat'],
+                       'lon':encoding_info['chunk_lon']}
+        var_encoding['chunksizes'] = tuple(min(chunk_sizes.get(d, n), n) for d, n in zip(data_array.dims, data_array.shape))
+        encoding[varname] = var_encoding
+    return encoding
 
-def get_forecasts_from_date(forecast_date, destination_folder,
-                            lead_time = 36, forecast_ensemble_size=5,
-                            current_season_observed=None):
-    """Download and process forecasts from a specific date
+def _write_cached_member(forecast_obj, cache_filename):
+    tmp_filename = '{f}.{pid}.tmp'.format(f=cache_filename, pid=os.getpid())
+    encoding = member_encoding(forecast_obj, _member_state['member_encoding'])
+    try:
+        forecast_obj.to_netcdf(tmp_filename, encoding=encoding)
+        os.replace(tmp_filename, cache_filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+def process_member(forecast_info, local_filenames):
+    """Convert, downscale, and write one forecast member. If it's in the
+    member cache nothing needs to be downloaded and local_filenames 
+    is not used.
     
+    Returns (status, message) where status is 'ok', 'skipped', or 'error'.
+    If there is no destination folder the member itself is returned in 
+    place of the message when it's successful.
+    """
+    first_forecast_day = _member_state['first_forecast_day']
+    last_forecast_day = _member_state['last_forecast_day']
+    initial_time= tools.string_to_date(forecast_info['initial_time'], h=True)
     
-    In the daily forecasting the date will be "today", but in hindcasting
-    will be dates in the  past. In which case it will obtain n forecasts 
-    starting on the 18 hour of the forecast date and working backword in 
-    time. n being equal to forecast_ensemble_size.
+    cache_filename = cached_member_filename(_member_state['member_cache_folder'],
+                                            forecast_info['initial_time'],
+                                            _member_state['model_version'])
+    if cached_member_usable(cache_filename, first_forecast_day, last_forecast_day):
+        with tracing.span('member_cache_read', initial_time=forecast_info['initial_time']):
+            with xr.open_dataset(cache_filename) as cached:
+                forecast_obj = cached.load()
+            os.utime(cache_filename)
+    else:
+        status, forecast_obj = _downscale_member(forecast_info, local_filenames)
+        if status != 'ok':
+            return status, forecast_obj
+        # Streaming ensembles don't write anything per member, so disk use
+        # doesn't grow with the ensemble size. 
+        if _member_state['destination_folder'] is not None:
+            try:
+                _write_cached_member(forecast_obj, cache_filename)
+            except:
+                print('could not write member cache ' + cache_filename)
     
-    ie. forecast_date = '20180215' will get forecasts at 
-    ['2018021518','2018021512','2018021506','2018021500','2018021418']
-    or more prior ones if <5 are available. 
+    # If the CFS forecast doesn't cover all the days we're shooting for skip
+    # it. Usually the end date is off a bunch, this happens occasionaly
+    # cause of I'm assuming, errors on NOAA's end
+    if not member_covers_days(forecast_obj, first_forecast_day, last_forecast_day):
+        if len(forecast_obj.time) == 0:
+            return 'skipped', 'Skipping due to bad forecast dates. no days in forecast'
+        return 'skipped', 'Skipping due to bad forecast dates. covers {s} to {e}'.format(s=forecast_obj.time[0].values,
+                                                                                         e=forecast_obj.time[-1].values)
     
-    current_season_observed
-        xarray object of one produced by download_latest_observations
+    # Limit to the lead time. 
+    member_days = forecast_obj.time.values.astype('datetime64[D]')
+    times_to_keep = np.logical_and(member_days >= _as_day(first_forecast_day), 
+                                   member_days <= _as_day(last_forecast_day))
+    forecast_obj = forecast_obj.isel(time = times_to_keep)
+    
+    # Members are only the forecast. The observations are joined when
+    # they are read, see tools.open_climate_member(). 
+    # Rounding errors can make it so lat/lon don't line up exactly with
+    # the observations, so they're set to exactly the same values.
+    observed_lat = _member_state['observed_lat']
+    observed_lon = _member_state['observed_lon']
+    if not (np.allclose(forecast_obj.lat.values, observed_lat, atol=1e-4) and 
+            np.allclose(forecast_obj.lon.values, observed_lon, atol=1e-4)):
+        return 'error', 'processing error, forecast grid does not match observations'
+    forecast_obj['lat'] = observed_lat
+    forecast_obj['lon'] = observed_lon
+    forecast_obj.attrs['observed_file'] = _member_state['observed_file']
+    
+    # Streaming ensembles use the member directly, see stream_forecast_members()
+    if _member_state['destination_folder'] is None:
+        return 'ok', forecast_obj
+    
+    # TODO: add provenance metadata
+    try:
+        processed_filename = _member_state['destination_folder']+'cfsv2_'+forecast_info['initial_time']+'.nc'
+        with tracing.span('write_netcdf', initial_time=forecast_info['initial_time']):
+            forecast_obj.to_netcdf(processed_filename, 
+                                   encoding=member_encoding(forecast_obj, _member_state['member_encoding']))
+    except:
+        return 'error', 'processing error in saving file'
+    
+    return 'ok', 'Successfuly proccessed forecast from initial time: '+str(initial_time)
+
+def _process_member_traced(forecast_info, local_filenames):
+    """process_member() along with the spans it finished, which are added 
+    to the ones in the main process with tracing.add_records()
+    """
+    with tracing.collect() as spans:
+        status, message = process_member(forecast_info, local_filenames)
+    return status, message, spans
+
+# Raw grib files are removed once a member is done with them. Any cached
+# ones are still in the raw file cache.
+def remove_member_files(local_filenames):
+    for local_filename in local_filenames.values():
+        for f in [local_filename, local_filename + '.part', local_filename + '.ranges']:
+            if os.path.exists(f):
+                os.remove(f)
+
+def _stop_other_threads(timeout=60):
+    """Stop the threads this process starts on its own before forking.
+    Returns the names of any still running."""
+    tools.close_download_manager()
+    listing_cache.wait_for_background_refreshes(timeout)
+    return [t.name for t in threading.enumerate() if t is not threading.current_thread()]
+
+@contextlib.contextmanager
+def member_executor(n_jobs, state):
+    """Where process_member() runs. With n_jobs=1 it's a single thread
+    in this process, otherwise a pool of n_jobs worker processes.
+    
+    Workers are forked so that scripts without a __main__ guard are not
+    re-run in them. They only do the processing, all downloads stay in
+    this process. Their temp folders are outside of tmp_folder, and are 
+    removed when the pool is shut down.
+    
+    Forking while another thread holds a lock can leave it locked in the
+    worker, so the download manager and any background listing refreshes
+    are stopped first. The download manager is started again the next 
+    time it's used. If some other thread is still running the members
+    are processed one at a time in this process instead.
+    """
+    if n_jobs > 1:
+        running_threads = _stop_other_threads()
+        if len(running_threads) > 0:
+            print('not forking member workers with other threads running: ' + ', '.join(running_threads))
+            n_jobs = 1
+    
+    if n_jobs == 1:
+        with futures.ThreadPoolExecutor(max_workers=1,
+                                        initializer=_init_member_worker,
+                                        initargs=(state,)) as executor:
+            yield executor
+        return
+    
+    workers_tmp_folder = tempfile.mkdtemp(prefix='climate_workers_') + '/'
+    try:
+        with futures.ProcessPoolExecutor(max_workers=n_jobs,
+                                         mp_context=multiprocessing.get_context('fork'),
+                                         initializer=_init_member_worker,
+                                         initargs=(state, workers_tmp_folder)) as executor:
+            # All the workers are forked with the first task
+            executor.submit(os.getpid).result()
+            yield executor
+    finally:
+        shutil.rmtree(workers_tmp_folder, ignore_errors=True)
+
+def process_members(forecast_date, destination_folder, lead_time = 36, 
+                    forecast_ensemble_size=5, current_season_observed=None, 
+                    observed_file=None, n_jobs=None):
+    """Download and process forecast members. This is a generator which 
+    yields (forecast_info, status, message) as each member is finished, 
+    see get_forecasts_from_date() for the arguments. 
+    
+    If destination_folder is None members are not written, and the 
+    forecast-only member is yielded in place of the message for
+    successful ones.
     """
     config = tools.load_config()
+    if n_jobs is None:
+        n_jobs = config['climate_n_jobs']
+    if observed_file is None:
+        observed_file = config['current_season_observations_file']
     
     if not current_season_observed:
         current_season_observed = xr.open_dataset(config['current_season_observations_file'])
     current_season_observed = current_season_observed.drop('status')
     
     land_mask = xr.open_dataset(config['mask_file'])
-    tmean_names = config['variables_to_use']['tmean']
     
     most_recent_observed_day = pd.Timestamp(current_season_observed.time.values[-1]).to_pydatetime()
     first_forecast_day = most_recent_observed_day + datetime.timedelta(days=1)
@@ -65,115 +374,196 @@ def get_forecasts_from_date(forecast_date, destination_folder,
     #today = pd.Timestamp.today().date()
     last_forecast_day = forecast_date + pd.offsets.Week(lead_time)
     
-    # Get info for more forecasts than needed in case some fail
-    # during processing. 4 forecasts are issued every day, so 10
-    # extra is about 2 days worth. 
-    cfs = cfs_tools.cfs_ftp_info()
-    most_recent_forecasts = cfs.last_n_forecasts(n=forecast_ensemble_size + 20,
-                                                 from_date=forecast_date)
-    cfs.close()
-    
-    # Arrange the downscale model to easily do array math with the 
-    # forecast arrays. And chunk it so it doesn't consume a large
-    # memory footprint (but takes a few minutes longer)
-    downscale_model = xr.open_dataset(config['downscaling_model_coefficients_file'])
-    downscale_model.load()
-    downscale_model = broadcast_downscale_model(downscale_model,
-                                                start_date=first_forecast_day,
-                                                end_date=last_forecast_day)
-    downscale_model = downscale_model.chunk({'lat':200,'lon':200})
+    # Only the 12 monthly coefficients, see cfs_tools.remap_and_downscale()
+    with tracing.span('load_downscale_model'):
+        downscale_model = xr.open_dataset(config['downscaling_model_coefficients_file'])
+        downscale_model.load()
     
-    num_forecasts_added = 0
-    print(len(most_recent_forecasts))
-    for forecast_info in most_recent_forecasts:
-        if num_forecasts_added == forecast_ensemble_size:
-            break
-        
-        local_filename = config['tmp_folder']+ os.path.basename(forecast_info['download_url'])
-        initial_time= tools.string_to_date(forecast_info['initial_time'], h=True)
-        
-        print('\n\n\n')
-        print('Attempting to process climate forecast {i} of {n} with initial time {t}'.format(i=num_forecasts_added,
-                                                                                       n=forecast_ensemble_size,
-                                                                                       t = initial_time))
-        print('download URL: ' + str(forecast_info['download_url']))
-
-        # If the observed data is late in updating and the forecast
-        # is very recent there will be gaps.
-        if initial_time.date() > first_forecast_day.date(): 
-            print('''Forecast skipped
-                     Gap between forecast and observed dates
-                     forecast initial time: {f_time}
-                     latest observed time: {o_time}
-                  '''.format(f_time=initial_time, o_time=first_forecast_day))
-            continue
+    land_mask.load()
+    member_state = {'first_forecast_day':first_forecast_day,
+                    'last_forecast_day':last_forecast_day,
+                    # Extra days so members can be reused from the cache
+                    'keep_until':last_forecast_day + pd.offsets.Day(config['processed_member_cache_days']),
+                    'land_mask':land_mask,
+                    'observed_lat':current_season_observed.lat.values,
+                    'observed_lon':current_season_observed.lon.values,
+                    # Relative so members can be copied to other hosts
+                    'observed_file':tools.data_folder_relative(observed_file),
+                    'downscale_model':downscale_model,
+                    'destination_folder':destination_folder,
+                    'member_encoding':config['climate_member_encoding'],
+                    'member_cache_folder':config['processed_member_cache_folder'],
+                    'model_version':downscale_model_version(config)}
     
-        try:
-            tools.download_file(forecast_info['download_url'], local_filename)
-            forecast_obj = cfs_tools.convert_cfs_grib_forecast(local_filename,
-                                                               add_initial_time_dim=False,
-                                                               date = initial_time)
-        except:
-            print('processing error in download/converting')
-            continue
-        
-        # If the last day of the CFS forecast is off a lot a bunch from the
-        # last day we're shooting for skip it. This happens occasionaly cause of
-        # I'm assuming, errors on NOAA's end
-        if forecast_obj.forecast_time[-1].values < np.datetime64(last_forecast_day):
-            print('Skipping due to bad forecast end date. ends on {d}'.format(d=forecast_obj.forecast_time[-1].values))
-            continue
-        
-        # ~1.0 deg cfs grid to 4km prism grid.
-        #TODO: use distance_weighted method with k:2
-        try:
-            forecast_obj = cfs_tools.spatial_downscale(ds = forecast_obj, 
-                                                       method='distance_weighted',
-                                                       downscale_args={'k':2},
-                                                       data_var='tmean',
-                                                       target_array = land_mask.to_array()[0])
-        except:
-            print('processing error in spatial downscale')
-            continue
-        
-        # Limit to the lead time. 
-        try:
-            dates_GE_first_day = forecast_obj.forecast_time.values >= np.datetime64(first_forecast_day)
-            dates_LE_last_day =  forecast_obj.forecast_time.values <= np.datetime64(last_forecast_day)
-            times_to_keep = np.logical_and(dates_GE_first_day, dates_LE_last_day)
-            forecast_obj = forecast_obj.isel(forecast_time = times_to_keep)
+    # Workers are started before the forecast listing and downloads here,
+    # which both use other threads.
+    with member_executor(n_jobs, member_state) as executor:
+        # Get info for more forecasts than needed in case some fail
+        # during processing. 4 forecasts are issued every day, so 10
+        # extra is about 2 days worth. 
+        with tracing.span('forecast_discovery'):
+            cfs = cfs_tools.cfs_ftp_info()
+            most_recent_forecasts = cfs.last_n_forecasts(n=forecast_ensemble_size + 20,
+                                                         from_date=forecast_date)
+            cfs.close()
+    
+        evict_member_cache(config['processed_member_cache_folder'], 
+                           max_age_days = config['processed_member_cache_days'])
+        is_cached = lambda initial_time: cached_member_usable(cached_member_filename(member_state['member_cache_folder'],
+                                                                                             initial_time,
+                                                                                             member_state['model_version']),
+                                                              first_forecast_day, last_forecast_day)
+    
+        # This is a pipeline of download -> process. The download manager 
+        # threads get the next climate_prefetch_members candidates while
+        # members are processed, so the next files are usually on disk by the 
+        # time a worker is free. Raw files are removed when their member is 
+        # done, so at most n_jobs + climate_prefetch_members + 1 are on disk.
+        download_manager = tools.download_manager()
+        downloads = {}
+        prefetch = config['climate_prefetch_members']
+    
+        # Members are processed in the order they are listed (most recent
+        # first). Only as many are in progress as are still needed, so the
+        # ones which succeed are the same as processing them one at a time.
+        num_forecasts_added = 0
+        in_progress = {}
+        candidates = iter(enumerate(most_recent_forecasts))
+        while True:
+            while len(in_progress) < min(n_jobs, forecast_ensemble_size - num_forecasts_added):
+                forecast_i, forecast_info = next(candidates, (None, None))
+                if forecast_info is None:
+                    break
+                
+                queue_forecast_downloads(download_manager, 
+                                         forecasts = most_recent_forecasts[forecast_i:],
+                                         downloads = downloads,
+                                         n = min(1 + prefetch, forecast_ensemble_size - num_forecasts_added),
+                                         first_forecast_day = first_forecast_day,
+                                         last_forecast_day = member_state['keep_until'],
+                                         tmp_folder = config['tmp_folder'],
+                                         partial_download = config['cfs_partial_download'],
+                                         is_cached = is_cached)
+                
+                local_filenames = {v:config['tmp_folder'] + os.path.basename(url) for v, url in forecast_info['download_urls'].items()}
+                initial_time= tools.string_to_date(forecast_info['initial_time'], h=True)
+                
+                print('\n\n\n')
+                print('Attempting to process climate forecast {i} of {n} with initial time {t}'.format(i=num_forecasts_added,
+                                                                                               n=forecast_ensemble_size,
+                                                                                               t = initial_time))
+                print('download URL: ' + str(forecast_info['download_url']))
+    
+                # If the observed data is late in updating and the forecast
+                # is very recent there will be gaps.
+                if initial_time.date() > first_forecast_day.date(): 
+                    print('''Forecast skipped
+                             Gap between forecast and observed dates
+                             forecast initial time: {f_time}
+                             latest observed time: {o_time}
+                          '''.format(f_time=initial_time, o_time=first_forecast_day))
+                    continue
+                
+                with tracing.span('download', initial_time=forecast_info['initial_time']):
+                    download_status = download_manager.wait(list(downloads[forecast_info['initial_time']].values()))
+                if any(download_status):
+                    print('processing error in download')
+                    remove_member_files(local_filenames)
+                    continue
+                
+                member = executor.submit(_process_member_traced, forecast_info, local_filenames)
+                in_progress[member] = (forecast_info, local_filenames, tracing.current_span())
             
-            # Apply downscaling model
-            forecast_obj = forecast_obj.rename({'forecast_time':'time'})
-            forecast_obj = forecast_obj.chunk({'lat':200,'lon':200})
+            if len(in_progress) == 0:
+                break
             
-            forecast_obj = forecast_obj['tmean'] * downscale_model.slope + downscale_model.intercept
-            forecast_obj = forecast_obj.to_dataset(name='tmean')
-        except:
-            print('processing error in downscaling')
-            continue
-        
-        # Add in observed observations
-        # rounding errors can make it so lat/lon don't line up exactly
-        # copying lat and lon fixes this.
-        try:
-            forecast_obj['lat'] = current_season_observed['lat']
-            forecast_obj['lon'] = current_season_observed['lon']
-            forecast_obj = xr.merge([forecast_obj, current_season_observed])
-        except:
-            print('processing error in merging with observed data')
-            continue
-        
-        # TODO: add provenance metadata
-        try:
-            processed_filename = destination_folder+'cfsv2_'+forecast_info['initial_time']+'.nc'
-            forecast_obj.to_netcdf(processed_filename)
-        except:
-            print('processing error in saving file')
+            finished, _ = futures.wait(in_progress, return_when=futures.FIRST_COMPLETED)
+            for member in finished:
+                forecast_info, local_filenames, submitted_in_span = in_progress.pop(member)
+                remove_member_files(local_filenames)
+                try:
+                    status, status_message, member_spans = member.result()
+                    # Spans from the worker go under the one this was submitted in
+                    tracing.add_records(member_spans, parent=submitted_in_span)
+                except Exception as e:
+                    # ie. a worker process died
+                    status, status_message = 'error', 'processing error: ' + repr(e)
+                if status == 'ok':
+                    num_forecasts_added+=1
+                yield forecast_info, status, status_message
+
+def get_forecasts_from_date(forecast_date, destination_folder,
+                            lead_time = 36, forecast_ensemble_size=5,
+                            current_season_observed=None, observed_file=None,
+                            n_jobs=None):
+    """Download and process forecasts from a specific date
+    
+    
+    In the daily forecasting the date will be "today", but in hindcasting
+    will be dates in the  past. In which case it will obtain n forecasts 
+    starting on the 18 hour of the forecast date and working backword in 
+    time. n being equal to forecast_ensemble_size.
+    
+    ie. forecast_date = '20180215' will get forecasts at 
+    ['2018021518','2018021512','2018021506','2018021500','2018021418']
+    or more prior ones if <5 are available. 
+    
+    current_season_observed
+        xarray object of one produced by download_latest_observations
+    
+    observed_file
+        The file the observations are read from when using the members
+        (see tools.open_climate_member()). Defaults to 
+        current_season_observations_file in the config file. Days from
+        it up to the first forecast day are used. Members store its path
+        relative to the data folder, so they can be used on other hosts.
+    
+    n_jobs
+        Number of members to process at the same time. Defaults to 
+        climate_n_jobs in the config file.
+    """
+    num_forecasts_added = 0
+    for forecast_info, status, status_message in process_members(forecast_date, destination_folder,
+                                                                 lead_time = lead_time,
+                                                                 forecast_ensemble_size = forecast_ensemble_size,
+                                                                 current_season_observed = current_season_observed,
+                                                                 observed_file = observed_file,
+                                                                 n_jobs = n_jobs):
+        print(status_message)
+        if status == 'ok':
+            num_forecasts_added+=1
+
+    assert num_forecasts_added==forecast_ensemble_size, 'not enough forecasts added. {added} of {needed}'.format(added=num_forecasts_added, 
+                                                                                                              needed=forecast_ensemble_size)
+
+def stream_forecast_members(forecast_date, lead_time = 36, forecast_ensemble_size=24,
+                            current_season_observed=None, n_jobs=None):
+    """Forecast members joined with the observed season, one at a time
+    
+    A generator for large ensembles. Nothing is written per member, not
+    even to the member cache (though cached members are still used), 
+    and only the members being processed plus the one being used are 
+    in memory. The arguments are the same as get_forecasts_from_date().
+    """
+    config = tools.load_config()
+    if not current_season_observed:
+        current_season_observed = xr.open_dataset(config['current_season_observations_file'])
+    observed = current_season_observed.drop('status').load()
+    
+    num_forecasts_added = 0
+    for forecast_info, status, member in process_members(forecast_date, destination_folder = None,
+                                                         lead_time = lead_time,
+                                                         forecast_ensemble_size = forecast_ensemble_size,
+                                                         current_season_observed = current_season_observed,
+                                                         n_jobs = n_jobs):
+        if status != 'ok':
+            print(member)
             continue
-        
-        print('Successfuly proccessed forecast from initial time: '+str(initial_time))
         num_forecasts_added+=1
-
+        print('Using climate forecast {i} of {n} with initial time {t}'.format(i=num_forecasts_added,
+                                                                              n=forecast_ensemble_size,
+                                                                              t=forecast_info['initial_time']))
+        yield tools.join_observed(member, observed)
+    
     assert num_forecasts_added==forecast_ensemble_size, 'not enough forecasts added. {added} of {needed}'.format(added=num_forecasts_added, 
                                                                                                               needed=forecast_ensemble_size)
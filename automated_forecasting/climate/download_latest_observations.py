@@ -45,42 +45,52 @@ def run():
     # Force the daily status to unicode. Otherwise xarray gets very confused
     observed_weather['status'] = observed_weather.status.astype('<U11')
     
-    # TODO: download all of them
+    days_to_add = []
     for day in prism_days_to_add:
         day = day.to_pydatetime()
         day_status = prism.get_date_status(day)
         print(day_status)
         if day_status is not None:
-            print('adding prism day ' + str(day))
-            day_url = prism.get_download_url(day)
-            day_xr= prism_tools.download_and_process_day(download_url=day_url,
-                                                         date=day,
-                                                         varname='tmean',
-                                                         status=day_status)
-            observed_weather = observed_weather.merge(day_xr)
+            days_to_add.append({'date':day, 'status':day_status,
+                                'url':prism.get_download_url(day)})
         else:
             pass
             # make a blank array for this day with status None
     
+    # Fetch all the new days at once, then add them one by one
+    prism_tools.download_days([d['url'] for d in days_to_add])
+    for d in days_to_add:
+        print('adding prism day ' + str(d['date']))
+        day_xr= prism_tools.process_day(download_url=d['url'],
+                                        date=d['date'],
+                                        varname='tmean',
+                                        status=d['status'])
+        observed_weather = observed_weather.merge(day_xr)
+    
     if len(prism_days_to_add)==0:
         print('No days to add')
     
     # Iterate thru the weather xarray again and attempt to update
     # anything that has changed status
-    days_updated=0
+    days_to_update = []
     for day in observed_weather.time.values:
         current_status = observed_weather.sel(time=day).status.values.tolist()
         ftp_status = prism.get_date_status(pd.Timestamp(day).to_pydatetime())
         if prism_tools.newer_file_available(current_status, ftp_status):
             day = pd.Timestamp(day).to_pydatetime()
             print('updating day {d} from {s1} to {s2}'.format(d=day, s1=current_status, s2=ftp_status))
-            day_url = prism.get_download_url(day)
-            updated_day_xr = prism_tools.download_and_process_day(download_url=day_url,
-                                                                  date=day,
-                                                                  varname='tmean',
-                                                                  status=ftp_status)
-            observed_weather = prism_tools.update_day(observed_weather, updated_day_xr)
-            days_updated+=1
+            days_to_update.append({'date':day, 'status':ftp_status,
+                                   'url':prism.get_download_url(day)})
+    
+    prism_tools.download_days([d['url'] for d in days_to_update])
+    days_updated=0
+    for d in days_to_update:
+        updated_day_xr = prism_tools.process_day(download_url=d['url'],
+                                                 date=d['date'],
+                                                 varname='tmean',
+                                                 status=d['status'])
+        observed_weather = prism_tools.update_day(observed_weather, updated_day_xr)
+        days_updated+=1
     
     if days_updated==0:
         print('No days updated to newer version')
@@ -1,8 +1,8 @@
 import xarray as xr
 import pandas as pd
 import numpy as np
-from tools import tools
-from tools.phenology_tools import predict_phenology_from_climate
+from tools import tools, tracing
+from tools.phenology_tools import predict_phenology_from_climate, predict_member, RunningMoments
 import os
 import datetime
 import time
@@ -13,9 +13,16 @@ from pyPhenology import utils
 
 def run(climate_forecast_folder = None, 
         phenology_forecast_folder = None,
-        species_list = None):
+        species_list = None,
+        climate_members = None):
     """Build phenology models
     
+    climate_members
+        An iterable of climate members (xarray objects with the observed
+        season joined), ie. cfs_forecasts.stream_forecast_members(). If 
+        set these are used instead of the files in climate_forecast_folder.
+        Each member is used once for all species, so it can be a generator
+        and only one member is in memory at a time.
     """
     divider='#'*90
     
@@ -47,10 +54,10 @@ def run(climate_forecast_folder = None,
     # Default location of climate forecasts
     if not climate_forecast_folder:
         climate_forecast_folder = config['current_forecast_folder']
-        
-    current_climate_forecast_files = glob.glob(climate_forecast_folder+'*.nc')
     
-    print(str(len(current_climate_forecast_files)) + ' current climate forecast files: \n' + str(current_climate_forecast_files))
+    if climate_members is None:
+        current_climate_forecast_files = glob.glob(climate_forecast_folder+'*.nc')
+        print(str(len(current_climate_forecast_files)) + ' current climate forecast files: \n' + str(current_climate_forecast_files))
     
     # Load default species list if no special one was passed
     if not species_list:
@@ -81,36 +88,78 @@ def run(climate_forecast_folder = None,
     
     #current_climate_forecasts = [xr.open_dataset(f) for f in current_climate_forecast_files]
     
-    num_species_processed=0
-    for i, forecast_info in enumerate(forecast_metadata.to_dict('records')):
-        species = forecast_info['species']
-        phenophase = forecast_info['Phenophase_ID']
-        model_file = config['phenology_model_folder']+forecast_info['model_file']
-        model = utils.load_saved_model(model_file)
-        
-        print(divider)
-        if species not in range_masks.species.values:
-            print('Skipping {s} {p}, no range mask'.format(s=species, p=phenophase))
-            continue
-        else:
+    def species_to_forecast():
+        for i, forecast_info in enumerate(forecast_metadata.to_dict('records')):
+            species = forecast_info['species']
+            phenophase = forecast_info['Phenophase_ID']
+            
+            print(divider)
+            if species not in range_masks.species.values:
+                print('Skipping {s} {p}, no range mask'.format(s=species, p=phenophase))
+                continue
+            
+            model_file = config['phenology_model_folder']+forecast_info['model_file']
+            yield i, species, phenophase, model_file, range_masks.sel(species=species)
+    
+    def file_ensemble_predictions():
+        num_species_processed = 0
+        for i, species, phenophase, model_file, species_range in species_to_forecast():
             print('Apply model for {s} {p}'.format(s=species, p=phenophase))
             print('forecast attempt {i} of {n} potential species. {n2} processed succesfully so far.'.format(i=i, n=len(forecast_metadata), n2=num_species_processed))
-            species_range = range_masks.sel(species=species)
+            model = utils.load_saved_model(model_file)
+            
+            with tracing.span('species_prediction', species=species, phenophase=phenophase):
+                prediction, prediction_sd = predict_phenology_from_climate(model,
+                                                                           current_climate_forecast_files,
+                                                                           post_process='automated',
+                                                                           doy_0=doy_0,
+                                                                           species_range=species_range,
+                                                                           n_jobs=config['n_jobs'])
+            num_species_processed+=1
+            yield species, phenophase, species_range, prediction, prediction_sd
+    
+    # With streamed members the loops are switched around. Each member 
+    # goes through every species model and then is dropped, while the 
+    # ensemble mean and sd for each species are kept up to date.
+    def streamed_ensemble_predictions():
+        species_models = []
+        for i, species, phenophase, model_file, species_range in species_to_forecast():
+            print('Loading model for {s} {p}'.format(s=species, p=phenophase))
+            species_models.append({'species':species,
+                                   'phenophase':phenophase,
+                                   'model':utils.load_saved_model(model_file),
+                                   'species_range':species_range,
+                                   'not_in_range':~species_range.range.values,
+                                   'moments':RunningMoments()})
+        
+        for member_i, climate in enumerate(climate_members):
+            print(divider)
+            print('Applying models to climate member {i}'.format(i=member_i))
+            for m in species_models:
+                with tracing.span('species_prediction', species=m['species'], phenophase=m['phenophase']):
+                    prediction = predict_member(m['model'], climate, doy_0, n_jobs=config['n_jobs'])
+                prediction[m['not_in_range']]=np.nan
+                m['moments'].add(prediction)
+        
+        for m in species_models:
+            # extend the axis by 2 to match the xarray creation
+            prediction = np.expand_dims(np.expand_dims(m['moments'].mean(), axis=0), axis=0)
+            prediction_sd = np.expand_dims(np.expand_dims(m['moments'].sd(), axis=0), axis=0)
+            yield m['species'], m['phenophase'], m['species_range'], prediction, prediction_sd
     
+    if climate_members is None:
+        species_predictions = file_ensemble_predictions()
+    else:
+        species_predictions = streamed_ensemble_predictions()
     
-        prediction, prediction_sd = predict_phenology_from_climate(model,
-                                                                   current_climate_forecast_files,
-                                                                   post_process='automated',
-                                                                   doy_0=doy_0,
-                                                                   species_range=species_range,
-                                                                   n_jobs=config['n_jobs'])
-        
+    num_species_processed=0
+    for species, phenophase, species_range, prediction, prediction_sd in species_predictions:
         species_forecast = xr.Dataset(data_vars = {'doy_prediction':(('species','phenophase', 'lat','lon'), prediction),
                                                    'doy_sd':(('species', 'phenophase', 'lat','lon'), prediction_sd)},
                                       coords = {'species':[species], 'phenophase':[phenophase],
                                               'lat':species_range.lat, 'lon':species_range.lon})
     
-        if i==0:
+        if num_species_processed==0:
             all_species_forecasts = species_forecast
             num_species_processed+=1
         else:
@@ -151,16 +200,17 @@ def run(climate_forecast_folder = None,
     forecast_filename = config['phenology_forecast_folder']+'phenology_forecast_'+str(today)+'.nc'
     
     all_species_forecasts = all_species_forecasts.chunk({'lat':50,'lon':50})
-    all_species_forecasts.to_netcdf(forecast_filename, encoding={'doy_prediction':{'zlib':True,
-                                                                                   'complevel':4, 
-                                                                                   'dtype':'int32', 
-                                                                                   'scale_factor':0.001,  
-                                                                                   '_FillValue': -9999},
-                                                                         'doy_sd':{'zlib':True,
-                                                                                   'complevel':4, 
-                                                                                   'dtype':'int32', 
-                                                                                   'scale_factor':0.001,  
-                                                                                   '_FillValue': -9999}})
+    with tracing.span('write_netcdf'):
+        all_species_forecasts.to_netcdf(forecast_filename, encoding={'doy_prediction':{'zlib':True,
+                                                                                       'complevel':4, 
+                                                                                       'dtype':'int32', 
+                                                                                       'scale_factor':0.001,  
+                                                                                       '_FillValue': -9999},
+                                                                             'doy_sd':{'zlib':True,
+                                                                                       'complevel':4, 
+                                                                                       'dtype':'int32', 
+                                                                                       'scale_factor':0.001,  
+                                                                                       '_FillValue': -9999}})
 
     # Return filename of final forecast file for use by primary script
     return forecast_filename
@@ -56,7 +56,7 @@ def run():
     
     # Load the climate forecasts
     
-    current_climate_forecasts = [xr.open_dataset(f) for f in current_climate_forecast_files]
+    current_climate_forecasts = [tools.open_climate_member(f) for f in current_climate_forecast_files]
     
     for i, forecast_info in enumerate(phenocam_models):
         model_nickname = forecast_info['nickname']
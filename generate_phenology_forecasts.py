@@ -1,4 +1,4 @@
-from tools import tools
+from tools import tools, raw_file_cache, tracing
 import time
 import datetime
 import subprocess
@@ -40,10 +40,15 @@ today = str(now().date())
 
 run_info = {'date':today}
 
+# Timing for each stage goes here as json lines, and a summary
+# of it into run_info.json
+tracing.set_trace_file(config['pipeline_trace_file'])
+
 # write the run_info.json file with a failure reason
 def write_failed_run_info(failure_reason):
     run_info['status'] = 'failed'
     run_info['failure_reason'] = failure_reason
+    run_info['stage_timing'] = tracing.summary()
     tools.write_json(run_info, config['run_status'])
 
 
@@ -55,7 +60,8 @@ tools.cleanup_tmp_folder(config['current_forecast_folder'])
 # Update prism observations
 message('Downloading latest observations ' + str(now()))
 try:
-    download_latest_observations.run()
+    with tracing.span('observations'):
+        download_latest_observations.run()
     message(min_elapsed() + ' min in downloading latest observations succeeded ' + str(now()))
 except:
     message(min_elapsed() + ' min in downloading latest observations failed ' + str(now()))
@@ -64,29 +70,70 @@ except:
 ###############################
 # Get the latest climate forecasts
 message('Downloading latest forecasts ' + str(now()))
-try:
-    cfs_forecasts.get_forecasts_from_date(forecast_date = now(),
-                                          destination_folder = config['current_forecast_folder'])
-    message(min_elapsed() + ' min in downloading latest forecasts succeeded ' + str(now()))
-except:
-    message(min_elapsed() + ' min in downloading latest forecasts failed ' + str(now()))
-    write_failed_run_info('failed downloading/processing climate forecasts')
-    raise
+# In streaming mode members are processed as the phenology models use 
+# them and never written, see cfs_forecasts.stream_forecast_members()
+streaming_ensemble = config['forecast_ensemble_mode'] == 'streaming'
+if streaming_ensemble:
+    message('Streaming mode, forecasts are processed while applying phenology models')
+else:
+    try:
+        with tracing.span('climate_forecasts'):
+            cfs_forecasts.get_forecasts_from_date(forecast_date = now(),
+                                                  destination_folder = config['current_forecast_folder'])
+        message(min_elapsed() + ' min in downloading latest forecasts succeeded ' + str(now()))
+    except:
+        message(min_elapsed() + ' min in downloading latest forecasts failed ' + str(now()))
+        write_failed_run_info('failed downloading/processing climate forecasts')
+        raise
 
 ###############################
 # apply phenology models
+
+# Climate forecast errors while streaming are reported as such, 
+# not as phenology model errors. The time getting each member is its
+# own climate_forecasts stage, and not part of phenology_models.
+climate_failed = False
+def streamed_climate_members():
+    global climate_failed
+    members = cfs_forecasts.stream_forecast_members(forecast_date = now(),
+                                                    forecast_ensemble_size = config['streaming_ensemble_size'])
+    try:
+        while True:
+            with tracing.separate_span('climate_forecasts'):
+                member = next(members, None)
+            if member is None:
+                return
+            yield member
+    except GeneratorExit:
+        members.close()
+        raise
+    except:
+        climate_failed = True
+        raise
+
 message('Applying phenology models ' + str(now()))
 try:
-    phenology_forecast_path = apply_phenology_models.run()
+    with tracing.span('phenology_models'):
+        if streaming_ensemble:
+            phenology_forecast_path = apply_phenology_models.run(climate_members = streamed_climate_members())
+        else:
+            phenology_forecast_path = apply_phenology_models.run()
     message(min_elapsed() + ' min in phenology models succeeded ' + str(now()))
 except:
-    message(min_elapsed() + ' min in phenology models failed ' + str(now()))
-    write_failed_run_info('failed applying phenology models')
+    if climate_failed:
+        message(min_elapsed() + ' min in downloading latest forecasts failed ' + str(now()))
+        write_failed_run_info('failed downloading/processing climate forecasts')
+    else:
+        message(min_elapsed() + ' min in phenology models failed ' + str(now()))
+        write_failed_run_info('failed applying phenology models')
     raise
 
 # write the run_info.json file with a success status and relavant info
 run_info['status'] = 'success'
 run_info['phenology_forecast_path'] = phenology_forecast_path
+# Used to verify the file after it's transfered off the hipergator
+run_info['phenology_forecast_sha256'] = raw_file_cache.file_sha256(phenology_forecast_path)
+run_info['stage_timing'] = tracing.summary()
 tools.write_json(run_info, config['run_status'])
 
 message('Automated forecasting finished at ' + str(now()))
@@ -58,4 +58,5 @@ for date_i, hindcast_issue_date in enumerate(date_range):
                                           destination_folder=climate_forecast_folder,
                                           lead_time = hindcast_config.climate_lead_time,
                                           forecast_ensemble_size= hindcast_config.num_climate_ensemble,
-                                          current_season_observed=current_season_observed)
+                                          current_season_observed=current_season_observed,
+                                          observed_file=current_season_observed_file)
@@ -100,10 +100,10 @@ for date_i, hindcast_issue_date in enumerate(date_range):
       
     # Take a peek at the first one to get the timestep count. needed to 
     # set the chunksize correctly.
-    num_timesteps = len(xr.open_dataset(current_climate_forecast_files[0]).time)
+    num_timesteps = len(tools.open_climate_member(current_climate_forecast_files[0]).time)
     # Load in the just generated climate foreasts. 
     # This is where the dask magic happens. These files are opened on the cluster
-    climate_ensemble = [xr.open_dataset(f, chunks={'time':num_timesteps,'lon':200,'lat':200}).persist() for f in current_climate_forecast_files]
+    climate_ensemble = [tools.open_climate_member(f, chunks={'time':num_timesteps,'lon':200,'lat':200}).persist() for f in current_climate_forecast_files]
     latitude_length = len(land_mask.lat)
     longitude_length = len(land_mask.lon)
     
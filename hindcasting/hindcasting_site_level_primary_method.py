@@ -124,12 +124,12 @@ for date_i, hindcast_issue_date in enumerate(date_range):
       
     # Take a peek at the first one to get the timestep count. needed to 
     # set the chunksize correctly.
-    num_timesteps = len(xr.open_dataset(current_climate_forecast_files[0]).time)
+    num_timesteps = len(tools.open_climate_member(current_climate_forecast_files[0]).time)
     latitude_length = len(land_mask.lat)
     longitude_length = len(land_mask.lon)
     
     for climate_i, climate_member_file in enumerate(current_climate_forecast_files):
-        climate_member = xr.open_dataset(climate_member_file, chunks={'time':50})
+        climate_member = tools.open_climate_member(climate_member_file, chunks={'time':50})
         climate_member.load()
         
         site_info_for_prediction = site_info.copy()
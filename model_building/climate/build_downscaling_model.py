@@ -2,7 +2,7 @@ import xarray as xr
 import pandas as pd
 import numpy as np
 from scipy.stats import linregress as lm
-from tools import prism_tools, cfs_tools, tools
+from tools import prism_tools, cfs_tools, tools, reanalysis_store
 import os
 import glob
 import warnings
@@ -26,8 +26,8 @@ config = tools.load_config()
 
 land_mask = xr.open_dataset(config['mask_file'])
 
-reanalysis_filenames = glob.glob(config['historic_reanalysis_folder']+'cfsv2_reanalysis*')
-reanalysis_obj = xr.open_mfdataset(reanalysis_filenames, chunks={'lat':10, 'lon':10})
+# Only months which made it into the store, see download_historic_reanalysis.py
+reanalysis_obj = reanalysis_store.open_store(config['historic_reanalysis_store_folder'])
 
 observation_filenames = glob.glob(config['historic_observations_folder']+'yearly/prism_tmean*')
 observations_obj = xr.open_mfdataset(observation_filenames, chunks={'lat':10, 'lon':10})
@@ -69,7 +69,7 @@ def boss():
     
     # Check which ones are available. After 2011 they are available every day,
     # every 6 hours. But reforecasts from 1982-2010 are only every 5th day
-    date_range_6h = [d for d in date_range_6h if cfs.forecast_available(d)]
+    date_range_6h = cfs.available_forecasts(date_range_6h)
     
     # Each job consists of a file to download along with it's associated
     # initial time
@@ -1,6 +1,6 @@
 import xarray as xr
 import pandas as pd
-from tools import cfs_tools, tools
+from tools import cfs_tools, tools, reanalysis_store
 import os
 
 ####################
@@ -31,13 +31,13 @@ class reanalysis_worker:
             obj = cfs_tools.process_reanalysis(filename=local_filename,
                                                date=reanalysis_date,
                                                target_downscale_array=self.land_mask.to_array()[0])
-            year = reanalysis_date.strftime('%Y')
-            month= reanalysis_date.strftime('%m')
-            processed_filename = self.config['data_folder']+'cfsv2_reanalysis_'+year+month+'.nc'
-            time_dims = len(obj.time)
-            obj.to_netcdf(processed_filename, encoding={'tmean': {'zlib':True, 
-                                                                  'complevel':1, 
-                                                                  'chunksizes':(10,10,time_dims)}})
+            month = reanalysis_date.strftime('%Y%m')
+            # Only days within this month, so neighboring months don't 
+            # write into each others region of the store.
+            obj = obj.isel(time = pd.DatetimeIndex(obj.time.values).strftime('%Y%m') == month)
+            reanalysis_store.write_month(self.config['historic_reanalysis_store_folder'],
+                                         obj = obj, month = month)
+            os.remove(local_filename)
             return_data={'status':0,'date':reanalysis_date}
         
         return return_data
@@ -58,10 +58,24 @@ class reanalysis_boss:
         # CFS reanalysis are monthly
         date_range_monthly = pd.date_range(begin_date, end_date, freq='MS').to_pydatetime()
         
+        # The store covers the full period up front, workers then
+        # fill in each month as it's processed.
+        land_mask = xr.open_dataset(self.config['mask_file'])
+        store_folder = self.config['historic_reanalysis_store_folder']
+        reanalysis_store.create_store(store_folder,
+                                      begin_date = begin_date,
+                                      end_date = date_range_monthly[-1] + pd.offsets.MonthEnd(1),
+                                      lat = land_mask.lat.values,
+                                      lon = land_mask.lon.values,
+                                      chunks = self.config['historic_reanalysis_store_chunks'])
+        completed_months = reanalysis_store.completed_months(store_folder)
+        
         cfs = cfs_tools.cfs_ftp_info()
     
         self.job_list=[]
         for d in date_range_monthly:
+            if d.strftime('%Y%m') in completed_months:
+                continue
             download_url = cfs.reanalysis_url_from_timestamp(reanalysis_time=d,
                                                              protocal='http')
             self.job_list.append({'download_url':download_url, 'date':d})
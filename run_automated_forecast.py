@@ -1,5 +1,6 @@
-from tools import tools
+from tools import tools, tracing
 import time
+import json
 import os
 import datetime
 import subprocess
@@ -36,42 +37,53 @@ message('Starting automated forecasting ' + str(now()))
 remote_control = tools.RemoteRunControl(con_info = config['remote_connection_info'],
                                         remote_status_filename=config['run_status'])
 
-remote_control.clear_status_file()
+# quit() raises SystemExit, so the ssh session is closed on every path out
+try:
+    remote_control.clear_status_file()
 
-remote_control.submit_job(remote_job_script=config['slurm_job_script'])
-message('job submitted at ' + str(now()))
+    remote_control.submit_job(remote_job_script=config['slurm_job_script'])
+    message('job submitted at ' + str(now()))
 
-while not remote_control.remote_run_complete():
-    time.sleep(60*10)
+    try:
+        with tracing.span('remote_run'):
+            remote_control.wait_for_completion()
+    except RuntimeError as e:
+        message('remote run failed. reason: ' + str(e))
+        quit()
 
-run_info = remote_control.remote_run_info()
+    run_info = remote_control.remote_run_info()
 
-if run_info['status'] == 'failed':
-    message('remote run failed. reason: ' + run_info['failure_reason'])
-    quit()
-else:
-    message('remote run succeeded at ' + str(now()))
+    if run_info['status'] == 'failed':
+        message('remote run failed. reason: ' + run_info['failure_reason'])
+        quit()
+    else:
+        message('remote run succeeded at ' + str(now()))
 
-###############################
-# Get the resulting file
-local_phenology_forecast_path = config['phenology_forecast_folder'] + os.path.basename(run_info['phenology_forecast_path'])
+    ###############################
+    # Get the resulting file
+    local_phenology_forecast_path = config['phenology_forecast_folder'] + os.path.basename(run_info['phenology_forecast_path'])
 
-transfer_successful = remote_control.get_file(remote_path=run_info['phenology_forecast_path'],
-                                              local_path=local_phenology_forecast_path)
+    with tracing.span('transfer_forecast'):
+        transfer_successful = remote_control.get_file(remote_path=run_info['phenology_forecast_path'],
+                                                      local_path=local_phenology_forecast_path,
+                                                      expected_sha256=run_info.get('phenology_forecast_sha256'))
 
-if not transfer_successful:
-    message('transfering phenology foreast file failed')
-    quit()
+    if not transfer_successful:
+        message('transfering phenology foreast file failed')
+        quit()
+finally:
+    remote_control.close()
     
 ###############################
 # Rebuild the website
 message('Updating phenology forecast website ' + str(now()))
 # Generate all the static forecast images
 try:
-    subprocess.call(['/usr/bin/Rscript',
-                     '--vanilla',
-                     'automated_forecasting/presentation/build_png_maps.R',
-                     local_phenology_forecast_path])
+    with tracing.span('build_images'):
+        subprocess.call(['/usr/bin/Rscript',
+                         '--vanilla',
+                         'automated_forecasting/presentation/build_png_maps.R',
+                         local_phenology_forecast_path])
     message('building static images succeeded ' + str(now()))
 except:
     message('building static images failed ' + str(now()))
@@ -81,12 +93,14 @@ except:
 from automated_forecasting.presentation import sync_website
 message('Syncing website data' + str(now()))
 try:
-    sync_website.run(update_all_images=True)
+    with tracing.span('sync_website'):
+        sync_website.run(update_all_images=True)
     message('Syncing website data succeeded')
 except:
     message('Syncing website data failed')
     raise
 
 message('Automated forecasting finished at ' + str(now()))
+print(json.dumps(tracing.summary(), indent=4))
 
 tools.cleanup_tmp_folder(config['tmp_folder'])
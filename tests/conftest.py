@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+# The tests import the tools package the same way the scripts do, from
+# the top of the repo, and the test server helper from this folder.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from local_http_server import LocalHTTPServer
+
+@pytest.fixture
+def server(tmp_path):
+    served_folder = tmp_path / 'served'
+    served_folder.mkdir()
+    s = LocalHTTPServer(str(served_folder))
+    yield s
+    s.close()
@@ -0,0 +1,150 @@
+import os
+import re
+import time
+import threading
+import http.server
+
+# A small http server for testing downloads against, serving the files in
+# a folder from 127.0.0.1 in a background thread. It keeps connections
+# alive, supports single Range requests, and can be told to misbehave:
+#
+#   server.fail_next(2)          next 2 GET requests get a 500
+#   server.truncate_next(1)      next GET sends a full Content-Length but
+#                                only half the body, then disconnects
+#   server.truncate_next(1, range_requests_only=True)
+#                                the same for the next GET with a Range
+#   server.support_range = False Range headers are ignored (200 + full file)
+#   server.delay = 0.2           seconds to wait before each response
+#
+# Every request is recorded in server.requests as (method, path, range),
+# and the most requests being handled at the same time in max_in_flight.
+
+class LocalHTTPServer():
+    def __init__(self, folder):
+        self.folder = folder
+        self.support_range = True
+        self.delay = 0
+        self.requests = []
+        self.connections = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._failures = []
+        self._lock = threading.Lock()
+
+        self._httpd = _QuietHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def url(self, filename):
+        return 'http://127.0.0.1:{p}/{f}'.format(p=self.port, f=filename)
+
+    def fail_next(self, n, status=500):
+        with self._lock:
+            self._failures.extend([(status, False)] * n)
+
+    def truncate_next(self, n, range_requests_only=False):
+        with self._lock:
+            self._failures.extend([('truncate', range_requests_only)] * n)
+
+    def _next_failure(self, is_range_request):
+        with self._lock:
+            if len(self._failures) == 0:
+                return None
+            failure, range_requests_only = self._failures[0]
+            if range_requests_only and not is_range_request:
+                return None
+            return self._failures.pop(0)[0]
+
+    def range_requests(self):
+        return [r for r in self.requests if r[2] is not None]
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+# Clients hanging up mid response (ie. after a 200 to a Range request)
+# is expected here, and not worth printing a traceback for.
+class _QuietHTTPServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        pass
+
+def _make_handler(server):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send_empty(self, status, headers={}):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def _respond(self, send_body):
+            range_header = self.headers.get('Range')
+            with server._lock:
+                server.requests.append((self.command, self.path, range_header))
+                server.connections.add(self.client_address)
+                server.in_flight += 1
+                server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            try:
+                time.sleep(server.delay)
+                self._respond_with_file(range_header, send_body)
+            finally:
+                with server._lock:
+                    server.in_flight -= 1
+
+        def _respond_with_file(self, range_header, send_body):
+            failure = server._next_failure(range_header is not None) if send_body else None
+            if isinstance(failure, int):
+                self._send_empty(failure)
+                return
+
+            filename = os.path.join(server.folder, self.path.lstrip('/'))
+            if not os.path.isfile(filename):
+                self._send_empty(404)
+                return
+            with open(filename, 'rb') as f:
+                data = f.read()
+            size = len(data)
+
+            status = 200
+            headers = {'ETag':'"{s}-{m}"'.format(s=size, m=int(os.path.getmtime(filename)))}
+            if range_header is not None and server.support_range:
+                match = re.match(r'bytes=(\d+)-(\d*)$', range_header)
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else size - 1
+                if start >= size:
+                    self._send_empty(416, {'Content-Range':'bytes */{s}'.format(s=size)})
+                    return
+                end = min(end, size - 1)
+                data = data[start:end + 1]
+                status = 206
+                headers['Content-Range'] = 'bytes {s}-{e}/{t}'.format(s=start, e=end, t=size)
+
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if not send_body:
+                return
+
+            if failure == 'truncate':
+                self.wfile.write(data[:len(data) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+            else:
+                self.wfile.write(data)
+
+        def do_GET(self):
+            self._respond(send_body=True)
+
+        def do_HEAD(self):
+            self._respond(send_body=False)
+
+    return Handler
@@ -0,0 +1,161 @@
+import os
+import time
+from tools import download_tools
+
+def write_served_file(server, filename, size=300000):
+    data = os.urandom(size)
+    with open(os.path.join(server.folder, filename), 'wb') as f:
+        f.write(data)
+    return data
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_download(server, tmp_path):
+    data = write_served_file(server, 'a.grb2')
+    manager = download_tools.DownloadManager(max_concurrent=2, retry_wait=0.1)
+    dest_path = str(tmp_path / 'a.grb2')
+    assert manager.download(server.url('a.grb2'), dest_path) == 0
+    assert read(dest_path) == data
+    assert not os.path.exists(dest_path + '.part')
+    manager.close()
+
+def test_missing_file_fails(server, tmp_path):
+    manager = download_tools.DownloadManager(num_attempts=2, retry_wait=0.1)
+    job = manager.submit(server.url('missing.grb2'), str(tmp_path / 'missing.grb2'))
+    assert manager.wait([job]) == [1]
+    assert '404' in job['error']
+    assert job['attempt'] == 2
+    manager.close()
+
+def test_resume_from_part_file(server, tmp_path):
+    data = write_served_file(server, 'a.grb2')
+    dest_path = str(tmp_path / 'a.grb2')
+    with open(dest_path + '.part', 'wb') as f:
+        f.write(data[:100000])
+
+    manager = download_tools.DownloadManager(retry_wait=0.1)
+    assert manager.download(server.url('a.grb2'), dest_path) == 0
+    assert read(dest_path) == data
+    assert server.range_requests() == [('GET', '/a.grb2', 'bytes=100000-')]
+    manager.close()
+
+def test_retry_with_backoff(server, tmp_path):
+    data = write_served_file(server, 'a.grb2')
+    server.fail_next(2)
+    manager = download_tools.DownloadManager(num_attempts=3, retry_wait=0.2)
+    dest_path = str(tmp_path / 'a.grb2')
+
+    start_time = time.time()
+    job = manager.submit(server.url('a.grb2'), dest_path)
+    assert manager.wait([job]) == [0]
+    # waits of 0.2 then 0.4 sec between the attempts
+    assert time.time() - start_time >= 0.6
+    assert job['attempt'] == 3
+    assert read(dest_path) == data
+    manager.close()
+
+def test_retry_wait_is_capped(server, tmp_path):
+    write_served_file(server, 'a.grb2')
+    server.fail_next(3)
+    manager = download_tools.DownloadManager(num_attempts=4, retry_wait=0.1, max_retry_wait=0.15)
+
+    start_time = time.time()
+    assert manager.download(server.url('a.grb2'), str(tmp_path / 'a.grb2')) == 0
+    # 0.1 + 0.15 + 0.15, not 0.1 + 0.2 + 0.4
+    assert time.time() - start_time < 0.6
+    manager.close()
+
+def test_gives_up_after_num_attempts(server, tmp_path):
+    write_served_file(server, 'a.grb2')
+    server.fail_next(5)
+    manager = download_tools.DownloadManager(retry_wait=0.1)
+    job = manager.submit(server.url('a.grb2'), str(tmp_path / 'a.grb2'), num_attempts=2)
+    assert manager.wait([job]) == [1]
+    assert '500' in job['error']
+    assert not os.path.exists(str(tmp_path / 'a.grb2'))
+    manager.close()
+
+def test_retry_does_not_block_other_jobs(server, tmp_path):
+    write_served_file(server, 'a.grb2')
+    write_served_file(server, 'b.grb2')
+    server.fail_next(1)
+    manager = download_tools.DownloadManager(max_concurrent=1, retry_wait=1)
+
+    failing_job = manager.submit(server.url('a.grb2'), str(tmp_path / 'a.grb2'))
+    other_job = manager.submit(server.url('b.grb2'), str(tmp_path / 'b.grb2'))
+    assert manager.wait([other_job]) == [0]
+    # The single worker got to b while a was waiting on its retry
+    assert failing_job['status'] is None
+    assert manager.wait([failing_job]) == [0]
+    manager.close()
+
+def test_wrong_content_length_is_resumed(server, tmp_path):
+    data = write_served_file(server, 'a.grb2')
+    server.truncate_next(1)
+    manager = download_tools.DownloadManager(retry_wait=0.1)
+    dest_path = str(tmp_path / 'a.grb2')
+
+    job = manager.submit(server.url('a.grb2'), dest_path)
+    assert manager.wait([job]) == [0]
+    assert job['attempt'] == 2
+    assert read(dest_path) == data
+    # The second attempt picked up where the truncated one left off
+    assert server.range_requests() == [('GET', '/a.grb2', 'bytes={o}-'.format(o=len(data)//2))]
+    manager.close()
+
+def test_stale_part_file_is_removed(server, tmp_path):
+    data = write_served_file(server, 'a.grb2', size=1000)
+    dest_path = str(tmp_path / 'a.grb2')
+    with open(dest_path + '.part', 'wb') as f:
+        f.write(os.urandom(5000))
+
+    manager = download_tools.DownloadManager(retry_wait=0.1)
+    assert manager.download(server.url('a.grb2'), dest_path) == 0
+    assert read(dest_path) == data
+    manager.close()
+
+def test_connections_reused_after_error_responses(server, tmp_path):
+    write_served_file(server, 'a.grb2')
+    server.fail_next(2)
+    manager = download_tools.DownloadManager(max_concurrent=1, num_attempts=3, retry_wait=0.1)
+    assert manager.download(server.url('a.grb2'), str(tmp_path / 'a.grb2')) == 0
+    # Error responses are read in full, so the connection goes back into
+    # the pool and all 3 attempts use it.
+    assert len(server.requests) == 3
+    assert len(server.connections) == 1
+    manager.close()
+
+def test_broken_connections_not_reused(server, tmp_path):
+    write_served_file(server, 'a.grb2')
+    write_served_file(server, 'b.grb2')
+    server.truncate_next(1)
+    manager = download_tools.DownloadManager(max_concurrent=1, retry_wait=0.1)
+    assert manager.download(server.url('a.grb2'), str(tmp_path / 'a.grb2')) == 0
+    assert manager.download(server.url('b.grb2'), str(tmp_path / 'b.grb2')) == 0
+    # The truncated response's connection was closed, not put back
+    assert len(server.connections) == 2
+    for idle in manager.pool._idle.values():
+        assert len(idle) <= manager.pool.max_per_host
+    manager.close()
+
+def test_concurrent_transfer_limit(server, tmp_path):
+    server.delay = 0.2
+    filenames = ['{i}.grb2'.format(i=i) for i in range(6)]
+    for filename in filenames:
+        write_served_file(server, filename, size=1000)
+
+    manager = download_tools.DownloadManager(max_concurrent=2)
+    statuses = manager.download_all([(server.url(f), str(tmp_path / f)) for f in filenames])
+    assert statuses == [0] * 6
+    assert server.max_in_flight == 2
+    manager.close()
+
+def test_head(server):
+    write_served_file(server, 'a.grb2', size=1234)
+    manager = download_tools.DownloadManager()
+    status, metadata = manager.head_status(server.url('a.grb2'))
+    assert status == 200 and metadata['size'] == 1234
+    assert manager.head_status(server.url('missing.grb2')) == (404, None)
+    manager.close()
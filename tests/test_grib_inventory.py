@@ -0,0 +1,111 @@
+import os
+import struct
+import datetime
+import pytest
+from tools import grib_inventory, download_tools
+
+initial_time = datetime.datetime(2018, 2, 15, 18)
+forecast_hours = list(range(0, 24*20, 6))
+
+# A minimal grib2 message with the sections grib_inventory reads: 0
+# (indicator), 1, 3 (a grid definition of grid_length bytes), 4 (product
+# definition template 4.0 with the forecast hour), 7 (data), and the end.
+def grib2_message(forecast_hour, grid_length=3000, data_length=5000):
+    section_1 = struct.pack('>IB', 21, 1) + b'\0'*16
+    section_3 = struct.pack('>IB', grid_length, 3) + b'\1'*(grid_length - 5)
+    section_4 = (struct.pack('>IBHH', 34, 4, 0, 0) + bytes([0, 0, 2, 0, 0]) + b'\0'*3 +
+                 bytes([1]) + struct.pack('>I', forecast_hour) + b'\0'*12)
+    section_7 = struct.pack('>IB', data_length + 5, 7) + bytes([forecast_hour % 256])*data_length
+    body = section_1 + section_3 + section_4 + section_7 + b'7777'
+    return b'GRIB\0\0\x00\x02' + struct.pack('>Q', 16 + len(body)) + body
+
+def idx_text(messages):
+    lines = []
+    offset = 0
+    for i, (forecast_hour, message) in enumerate(zip(forecast_hours, messages)):
+        forecast = 'anl' if forecast_hour == 0 else '{h} hour fcst'.format(h=forecast_hour)
+        lines.append('{i}:{o}:d=2018021518:TMP:2 m above ground:{f}:'.format(i=i+1, o=offset, f=forecast))
+        offset += len(message)
+    return '\n'.join(lines) + '\n'
+
+@pytest.fixture
+def grib_messages(server):
+    messages = [grib2_message(h) for h in forecast_hours]
+    with open(os.path.join(server.folder, 'tmp2m.grb2'), 'wb') as f:
+        f.write(b''.join(messages))
+    return messages
+
+def expected_partial_file(messages, first_day, last_day):
+    return b''.join(m for h, m in zip(forecast_hours, messages)
+                    if first_day <= (initial_time + datetime.timedelta(hours=h)).date() <= last_day)
+
+def full_file_requests(server):
+    return [r for r in server.requests if r[0] == 'GET' and r[2] is None and not r[1].endswith('.idx')]
+
+def run_partial_transfer(server, tmp_path, manager=None):
+    manager = manager or download_tools.DownloadManager(retry_wait=0.1)
+    transfer = grib_inventory.partial_transfer(manager, initial_time,
+                                               first_day = datetime.date(2018, 2, 18),
+                                               last_day = datetime.date(2018, 2, 20))
+    dest_path = str(tmp_path / 'tmp2m.grb2')
+    job = manager.submit(server.url('tmp2m.grb2'), dest_path, transfer=transfer)
+    status = manager.wait([job])[0]
+    manager.close()
+    with open(dest_path, 'rb') as f:
+        return status, job, f.read()
+
+def test_inventory_from_idx(server, grib_messages):
+    with open(os.path.join(server.folder, 'tmp2m.grb2.idx'), 'w') as f:
+        f.write(idx_text(grib_messages))
+    inventory = grib_inventory.get_inventory(download_tools.DownloadManager(), server.url('tmp2m.grb2'))
+    assert [m['forecast_hour'] for m in inventory] == forecast_hours
+    assert [m['length'] for m in inventory] == [len(m) for m in grib_messages]
+    assert len(server.range_requests()) == 0
+
+def test_inventory_from_headers(server, grib_messages):
+    inventory = grib_inventory.get_inventory(download_tools.DownloadManager(), server.url('tmp2m.grb2'))
+    assert [m['forecast_hour'] for m in inventory] == forecast_hours
+    assert [m['length'] for m in inventory] == [len(m) for m in grib_messages]
+    # One request per message header
+    assert len(server.range_requests()) == len(grib_messages)
+
+def test_header_scan_needs_product_definition_in_header(server, grib_messages):
+    fetch_range = lambda start, end: download_tools.DownloadManager().fetch_range(server.url('tmp2m.grb2'), start, end)
+    with pytest.raises(ValueError):
+        grib_inventory.scan_grib2_headers(fetch_range, len(b''.join(grib_messages)), header_bytes=1000)
+
+@pytest.mark.parametrize('with_idx', [True, False])
+def test_partial_transfer(server, tmp_path, grib_messages, with_idx):
+    if with_idx:
+        with open(os.path.join(server.folder, 'tmp2m.grb2.idx'), 'w') as f:
+            f.write(idx_text(grib_messages))
+    status, job, data = run_partial_transfer(server, tmp_path)
+    assert status == 0
+    assert data == expected_partial_file(grib_messages, datetime.date(2018, 2, 18), datetime.date(2018, 2, 20))
+    assert len(full_file_requests(server)) == 0
+    assert not os.path.exists(str(tmp_path / 'tmp2m.grb2.part'))
+    assert not os.path.exists(str(tmp_path / 'tmp2m.grb2.ranges'))
+
+def test_partial_transfer_resumes(server, tmp_path, grib_messages):
+    with open(os.path.join(server.folder, 'tmp2m.grb2.idx'), 'w') as f:
+        f.write(idx_text(grib_messages))
+    server.truncate_next(1, range_requests_only=True)
+    status, job, data = run_partial_transfer(server, tmp_path)
+    assert status == 0
+    assert data == expected_partial_file(grib_messages, datetime.date(2018, 2, 18), datetime.date(2018, 2, 20))
+    # The second attempt only asks for what's left of the range
+    ranges = server.range_requests()
+    assert len(ranges) == 2
+    first_start = int(ranges[0][2].split('=')[1].split('-')[0])
+    resumed_start = int(ranges[1][2].split('=')[1].split('-')[0])
+    assert resumed_start > first_start
+    assert job['attempt'] == 2
+
+def test_server_without_range_requests(server, tmp_path, grib_messages):
+    server.support_range = False
+    status, job, data = run_partial_transfer(server, tmp_path)
+    assert status == 0
+    assert data == b''.join(grib_messages)
+    # The header scan stops at the first range request, then the full file
+    assert len(server.range_requests()) == 1
+    assert len(full_file_requests(server)) == 1
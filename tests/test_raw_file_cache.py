@@ -0,0 +1,85 @@
+import os
+import stat
+import time
+import json
+from tools import raw_file_cache
+
+url = 'https://example.com/a.grb2'
+metadata = {'etag':'"abc"', 'last_modified':None, 'size':1000}
+
+def write_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def age_entry(cache, days):
+    key_filename = cache._key_filename(cache._key(url, metadata))
+    with open(key_filename) as f:
+        entry = json.load(f)
+    entry['verified'] -= days * 24 * 3600
+    with open(key_filename, 'w') as f:
+        json.dump(entry, f)
+
+def count_hashes(monkeypatch):
+    hashed = []
+    original = raw_file_cache.file_sha256
+    def file_sha256(filename, *args):
+        hashed.append(filename)
+        return original(filename, *args)
+    monkeypatch.setattr(raw_file_cache, 'file_sha256', file_sha256)
+    return hashed
+
+def test_put_and_get(tmp_path):
+    cache = raw_file_cache.RawFileCache(str(tmp_path / 'cache'))
+    src = str(tmp_path / 'a.grb2')
+    data = os.urandom(1000)
+    write_file(src, data)
+    cache.put(url, src, metadata=metadata)
+
+    dest = str(tmp_path / 'b.grb2')
+    assert cache.get(url, dest, metadata=metadata)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert not cache.get(url, dest, metadata=dict(metadata, etag='"new"'))
+
+def test_put_leaves_source_file_alone(tmp_path):
+    cache = raw_file_cache.RawFileCache(str(tmp_path / 'cache'))
+    src = str(tmp_path / 'a.grb2')
+    write_file(src, os.urandom(1000))
+    cache.put(url, src, metadata=metadata)
+
+    assert os.stat(src).st_mode & stat.S_IWUSR
+    assert os.stat(src).st_nlink == 1
+    # And it can still be written to
+    write_file(src, b'changed')
+    assert cache.lookup(url, metadata=metadata) is not None
+
+def test_checksum_only_reverified_when_old(tmp_path, monkeypatch):
+    cache = raw_file_cache.RawFileCache(str(tmp_path / 'cache'), reverify_days=30)
+    src = str(tmp_path / 'a.grb2')
+    write_file(src, os.urandom(1000))
+    cache.put(url, src, metadata=metadata)
+
+    hashed = count_hashes(monkeypatch)
+    for i in range(3):
+        assert cache.lookup(url, metadata=metadata) is not None
+    assert len(hashed) == 0
+
+    age_entry(cache, days=31)
+    assert cache.lookup(url, metadata=metadata) is not None
+    assert cache.lookup(url, metadata=metadata) is not None
+    assert len(hashed) == 1
+
+def test_corrupt_blob_removed(tmp_path):
+    cache = raw_file_cache.RawFileCache(str(tmp_path / 'cache'))
+    src = str(tmp_path / 'a.grb2')
+    write_file(src, os.urandom(1000))
+    cache.put(url, src, metadata=metadata)
+
+    blob_filename = cache.lookup(url, metadata=metadata)
+    os.chmod(blob_filename, 0o644)
+    write_file(blob_filename, os.urandom(1000))
+    # Same size, so only found once the checksum is due
+    assert cache.lookup(url, metadata=metadata) is not None
+    age_entry(cache, days=31)
+    assert cache.lookup(url, metadata=metadata) is None
+    assert not os.path.exists(blob_filename)
@@ -0,0 +1,43 @@
+import time
+import pytest
+from tools import tracing
+
+@pytest.fixture(autouse=True)
+def clean_tracing():
+    tracing.reset()
+    yield
+    tracing.reset()
+
+def members(n):
+    for i in range(n):
+        with tracing.span('download'):
+            time.sleep(0.1)
+        yield i
+
+def test_separate_span_inside_another_stage():
+    member_iter = members(3)
+    with tracing.span('phenology_models'):
+        while True:
+            with tracing.separate_span('climate_forecasts'):
+                member = next(member_iter, None)
+            if member is None:
+                break
+            with tracing.span('predict'):
+                time.sleep(0.05)
+
+    summary = tracing.summary()
+    assert set(summary) == {'phenology_models', 'phenology_models/predict',
+                            'climate_forecasts', 'climate_forecasts/download'}
+    assert summary['climate_forecasts/download']['count'] == 3
+    # The phenology stage doesn't include the time getting members
+    assert summary['climate_forecasts']['wall_sec'] >= 0.3
+    assert summary['phenology_models']['wall_sec'] < 0.25
+
+def test_spans_after_separate_span_keep_their_parent():
+    with tracing.span('outer') as outer:
+        with tracing.separate_span('other'):
+            pass
+        assert tracing.current_span() is outer
+        with tracing.span('inner'):
+            pass
+    assert 'outer/inner' in tracing.summary()
@@ -1,24 +1,113 @@
 import xarray as xr
+import pandas as pd
 from ftplib import FTP
 import ftplib
 import datetime
 import numpy as np
-import xmap
 import os
+import hashlib
+from scipy import sparse
+from scipy.spatial import cKDTree
 from warnings import warn
+import warnings
 import urllib
 import time
-from tools import tools
+from concurrent.futures import ThreadPoolExecutor
+from tools import tools, listing_cache
 
 config = tools.load_config()
 
+# A record of which CFS forecast files are on the server, kept on disk
+# between runs. Entries are initial_time (YYYYMMDDHH) -> url, availability,
+# size, and when it was last checked. Files which are available are only
+# checked again after recheck_available_days, in case they were removed
+# from the server. Missing files are re-checked only when the initial time
+# is recent, since new forecasts show up on the server over a day or two.
+# Only a not found response counts as missing. Checks which fail (ie. a
+# timeout or server error) are left out of the index so they are retried.
+class cfs_availability_index:
+    def __init__(self, index_file=None, recheck_window_days=10, 
+                 recheck_after_hours=1, recheck_available_days=30,
+                 max_concurrent=16):
+        if index_file is None:
+            index_file = config['cfs_availability_index_file']
+        self.index_file = index_file
+        self.recheck_window = datetime.timedelta(days=recheck_window_days)
+        self.recheck_after = datetime.timedelta(hours=recheck_after_hours)
+        self.recheck_available_after = datetime.timedelta(days=recheck_available_days)
+        self.max_concurrent = max_concurrent
+        self.entries = self._read_index()
+    
+    def _read_index(self):
+        if os.path.exists(self.index_file):
+            return tools.read_json(self.index_file)
+        else:
+            return {}
+    
+    def save(self):
+        # Merge with whatever other processes have written in the meantime
+        with tools.file_lock(self.index_file):
+            entries = self._read_index()
+            for initial_time, entry in self.entries.items():
+                if initial_time not in entries or entries[initial_time]['last_checked'] < entry['last_checked']:
+                    entries[initial_time] = entry
+            tmp_filename = '{f}.{pid}.tmp'.format(f=self.index_file, pid=os.getpid())
+            tools.write_json(entries, tmp_filename, overwrite=True)
+            os.replace(tmp_filename, self.index_file)
+        self.entries = entries
+    
+    def _needs_check(self, forecast_time, now):
+        entry = self.entries.get(tools.date_to_string(forecast_time, h=True))
+        if entry is None:
+            return True
+        
+        last_checked = datetime.datetime.fromtimestamp(entry['last_checked'])
+        if entry['available']:
+            return now - last_checked > self.recheck_available_after
+        
+        is_recent = now - forecast_time < self.recheck_window
+        return is_recent and now - last_checked > self.recheck_after
+    
+    def _check_one(self, forecast_time, url):
+        status, metadata = tools.download_manager().head_status(url)
+        if status not in [200, 404, 410]:
+            return None
+        return {'url':url,
+                'available':metadata is not None,
+                'size':metadata['size'] if metadata else None,
+                'last_checked':time.time()}
+    
+    def update(self, forecast_times, url_function):
+        """Check the server for any forecast_times not in the index, or
+        which need re-checking. Checks are done concurrently with
+        HEAD requests. url_function converts a datetime to a download url.
+        """
+        now = datetime.datetime.now()
+        to_check = [t for t in forecast_times if self._needs_check(t, now)]
+        if len(to_check) == 0:
+            return
+        
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            results = executor.map(lambda t: self._check_one(t, url_function(t)), to_check)
+            for forecast_time, entry in zip(to_check, results):
+                if entry is None:
+                    print('availability check failed, will retry: ' + url_function(forecast_time))
+                    continue
+                self.entries[tools.date_to_string(forecast_time, h=True)] = entry
+        
+        self.save()
+    
+    def available(self, forecast_time):
+        entry = self.entries.get(tools.date_to_string(forecast_time, h=True))
+        return entry is not None and entry['available']
+
 class cfs_ftp_info:
     def __init__(self):
         self.host='nomads.ncdc.noaa.gov'
         self.forecast_dirs={'http':{'operational':'modeldata/cfsv2_forecast_ts_9mon/',
-                                    'reforecast': 'data/cfsr-rfl-ts9/tmp2m/'},
+                                    'reforecast': 'data/cfsr-rfl-ts9/'},
                             'ftp':{'operational':'modeldata/cfsv2_forecast_ts_9mon/',
-                                   'reforecast':'CFSRR/cfsr-rfl-ts9/tmp2m/'}
+                                   'reforecast':'CFSRR/cfsr-rfl-ts9/'}
                             }
         self.reanalysis_dirs={'http':{'operational':'modeldata/cfsv2_analysis_timeseries/',
                                     'pre_2011': 'data/cfsr/'},
@@ -29,6 +118,9 @@ class cfs_ftp_info:
         # Do not connect t the ftp by default
         #self.connect()
         self._folder_file_lists={}
+        self._listing_cache = listing_cache.FolderListingCache(config['listing_cache_folder'],
+                                                               namespace='cfs_'+self.host)
+        self._availability_index = None
     
     def connect(self, attempts_made=0):
         warn('noaa FTP server has been down for a while')
@@ -72,44 +164,99 @@ class cfs_ftp_info:
                 self.connect()
                 return self._query_ftp_folder(folder, attempts_made = attempts_made + 1)
     
+    # For refreshing listings in the background, which can't share
+    # the main connection.
+    def _query_ftp_folder_new_connection(self, folder):
+        con = FTP(host=self.host, user='anonymous', passwd='abc123')
+        try:
+            return con.nlst(folder)
+        except ftplib.error_temp:
+            return []
+        finally:
+            con.close()
+    
+    # CFS folders are named by year (YYYY), month (YYYYMM), day (YYYYMMDD), 
+    # or forecast initial time (YYYYMMDDHH). Ones whose period ended more 
+    # than 10 days ago are closed, ie. nothing else will be added. Those
+    # are rarely re-listed, and when they are it's done in the background.
+    # Recent ones are re-listed often.
+    def _folder_is_closed(self, folder):
+        folder_name = folder.strip('/').split('/')[-1]
+        folder_periods = {4:('%Y', pd.offsets.YearBegin(1)),
+                          6:('%Y%m', pd.offsets.MonthBegin(1)),
+                          8:('%Y%m%d', pd.offsets.Day(1)),
+                          10:('%Y%m%d%H', pd.offsets.Hour(6))}
+        if not folder_name.isdigit() or len(folder_name) not in folder_periods:
+            return False
+        date_format, period_length = folder_periods[len(folder_name)]
+        period_end = pd.Timestamp(datetime.datetime.strptime(folder_name, date_format)) + period_length
+        return datetime.datetime.today() - period_end > datetime.timedelta(days=10)
+    
     #Ensure that each folder is only queried once
     def _get_folder_listing(self, folder):
         if folder in self._folder_file_lists:
             return self._folder_file_lists[folder]
         else:
-            dir_listing = self._query_ftp_folder(folder)
+            if self._folder_is_closed(folder):
+                dir_listing = self._listing_cache.get(folder,
+                                                      ttl = config['listing_cache_ttl_hours']['closed']*3600,
+                                                      fetch = self._query_ftp_folder_new_connection,
+                                                      refresh_in_background = True)
+            else:
+                dir_listing = self._listing_cache.get(folder,
+                                                      ttl = config['listing_cache_ttl_hours']['current']*3600,
+                                                      fetch = self._query_ftp_folder)
             self._folder_file_lists[folder]=dir_listing
             return dir_listing
         
-    def forecast_available(self, forecast_time):
-        if isinstance(forecast_time, str):
-            forecast_time = tools.string_to_date(forecast_time, h=True)
+    def _get_availability_index(self):
+        if self._availability_index is None:
+            self._availability_index = cfs_availability_index()
+        return self._availability_index
+    
+    def available_forecasts(self, forecast_times):
+        """The subset of forecast_times which are available on the server.
+        Anything not already in the availability index is checked 
+        concurrently.
+        """
+        forecast_times = [tools.string_to_date(t, h=True) if isinstance(t, str) else t for t in forecast_times]
         
         # 2011 to present is pretty complete, and also time consuming
         # to check. So of it's in this range just assume it's there
         cutoff_begin = tools.string_to_date('2011040100', h=True)
         cutoff_end   = tools.string_to_date('2017070100', h=True)
-        if forecast_time >= cutoff_begin and forecast_time <= cutoff_end:
-            return True
+        assumed_available = lambda t: t >= cutoff_begin and t <= cutoff_end
         
-        forecast_filename = self.forecast_url_from_timestamp(forecast_time, path_type='full_path',
-                                                             protocal='http')
-        return tools.file_available(forecast_filename)
+        index = self._get_availability_index()
+        index.update([t for t in forecast_times if not assumed_available(t)],
+                     url_function = lambda t: self.forecast_url_from_timestamp(t, path_type='full_path',
+                                                                               protocal='http'))
+        
+        return [t for t in forecast_times if assumed_available(t) or index.available(t)]
     
+    def forecast_available(self, forecast_time):
+        return len(self.available_forecasts([forecast_time])) == 1
+        
     # TODO: variable filename to download precip as well
     # forecast download paths look like: 
     # ftp://nomads.ncdc.noaa.gov/modeldata/cfsv2_forecast_ts_9mon/2017/201711/20171111/2017111118/tmp2m.01.2017111118.daily.grb2
     # reforecast paths (prior to 2011) are:
     # ftp://nomads.ncdc.noaa.gov/CFSRR/cfsr-rfl-ts9/tmp2m/200808/tmp2m.2008080418.time.grb2
+    # where reforecasts for each variable are in a folder named by its file prefix.
     # path_types: 
     # folder returns the containing folder but not the protocal or 
     # filename returns only the filename
     # full path returns the full download link
-    def forecast_url_from_timestamp(self, forecast_time, path_type='full_path', protocal='http'):
+    # varname is an entry in variables_to_use in the config file, each 
+    # variable is in its own file.
+    def forecast_url_from_timestamp(self, forecast_time, path_type='full_path', protocal='http',
+                                    varname='tmean'):
         assert path_type in ['full_path','folder','filename'] , 'unknown path type: '+str(path_type)
         assert protocal in ['http','ftp'] , 'unknown protocal: '+str(protocal)
         if isinstance(forecast_time, str):
             forecast_time = tools.string_to_date(forecast_time, h=True)
+        
+        file_prefix = config['variables_to_use'][varname]['cfs_file_prefix']
             
         year = forecast_time.strftime('%Y')
         month= forecast_time.strftime('%m')
@@ -117,10 +264,10 @@ class cfs_ftp_info:
         hour = forecast_time.strftime('%H')
         to_return={}
         if int(year) < 2011:
-            to_return['filename'] = 'tmp2m.'+tools.date_to_string(forecast_time,h=True)+'.time.grb2'
-            to_return['folder'] = self.forecast_dirs[protocal]['reforecast']+'/'+year+month +'/'
+            to_return['filename'] = file_prefix+'.'+tools.date_to_string(forecast_time,h=True)+'.time.grb2'
+            to_return['folder'] = self.forecast_dirs[protocal]['reforecast']+file_prefix+'/'+year+month +'/'
         else:
-            to_return['filename'] = 'tmp2m.01.'+tools.date_to_string(forecast_time,h=True)+'.daily.grb2'
+            to_return['filename'] = file_prefix+'.01.'+tools.date_to_string(forecast_time,h=True)+'.daily.grb2'
             to_return['folder'] = self.forecast_dirs[protocal]['operational']+'/'+year+'/'+year+month+'/'+year+month+day+'/'+year+month+day+hour+'/'
         
         to_return['full_path'] = protocal+'://' + self.host +'/' + to_return['folder'] + to_return['filename']
@@ -163,20 +310,100 @@ class cfs_ftp_info:
         
         six_hours = datetime.timedelta(hours=6)
         
+        # Check a batch of timestamps at a time, going back further 
+        # until there are enough.
         all_forecasts = []
         while len(all_forecasts) < n:
-            latest_forecast_timestamp-=six_hours
-
-            if not self.forecast_available(latest_forecast_timestamp):
-                continue
-            latest_forecast_str = tools.date_to_string(latest_forecast_timestamp, h=True)
+            batch = [latest_forecast_timestamp - six_hours*i for i in range(1, 2*n + 1)]
+            latest_forecast_timestamp = batch[-1]
             
-            all_forecasts.append({'initial_time':latest_forecast_str,
-                                  'download_url':self.forecast_url_from_timestamp(latest_forecast_timestamp, protocal='http')})
+            for forecast_timestamp in self.available_forecasts(batch):
+                if len(all_forecasts) == n:
+                    break
+                latest_forecast_str = tools.date_to_string(forecast_timestamp, h=True)
+                # download_url is tmean, download_urls has every configured variable
+                download_urls = {v:self.forecast_url_from_timestamp(forecast_timestamp, protocal='http', varname=v) for v in config['variables_to_use']}
+                all_forecasts.append({'initial_time':latest_forecast_str,
+                                      'download_url':download_urls['tmean'],
+                                      'download_urls':download_urls})
 
         return all_forecasts
     
     
+# Mean over axis 0, which falls back to nanmean only when there are
+# missing values. This matches xarray's default skipna=True.
+def _mean_skipna(values, axis=0, keepdims=False):
+    mean = values.mean(axis=axis, keepdims=keepdims)
+    if np.isnan(mean).any():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            mean = np.nanmean(values, axis=axis, keepdims=keepdims)
+    return mean
+
+def _daily_mean_values(values, times, steps_per_day=4):
+    """Daily means of a regular series with steps_per_day timesteps per day
+    
+    values is an array with time as the first axis, times the datetime64
+    for each. The full days in the middle are reshaped to 
+    (day, steps_per_day, ...) and reduced without copying, partial first
+    and last days are averaged over whatever timesteps they have.
+    
+    Returns (days, daily_values), or None if the series is not regular.
+    """
+    times = times.astype('datetime64[ns]')
+    step = np.timedelta64(24*60//steps_per_day, 'm')
+    if len(times) == 0:
+        return None
+    if len(times) > 1 and not np.all(np.diff(times) == step):
+        return None
+    
+    first_day = times[0].astype('datetime64[D]')
+    offset_into_first_day = times[0] - first_day
+    if offset_into_first_day % step != np.timedelta64(0, 'ns'):
+        return None
+    steps_missing_on_first_day = int(offset_into_first_day // step)
+    
+    n_times = len(times)
+    n_head = min((steps_per_day - steps_missing_on_first_day) % steps_per_day, n_times)
+    n_body = ((n_times - n_head) // steps_per_day) * steps_per_day
+    n_tail = n_times - n_head - n_body
+    
+    daily_values = []
+    if n_head > 0:
+        daily_values.append(_mean_skipna(values[:n_head], axis=0, keepdims=True))
+    if n_body > 0:
+        body = values[n_head:n_head+n_body]
+        body = body.reshape((n_body // steps_per_day, steps_per_day) + values.shape[1:])
+        daily_values.append(_mean_skipna(body, axis=1))
+    if n_tail > 0:
+        daily_values.append(_mean_skipna(values[n_head+n_body:], axis=0, keepdims=True))
+    daily_values = np.concatenate(daily_values, axis=0)
+    
+    days = first_day + np.arange(daily_values.shape[0]).astype('timedelta64[D]')
+    return days.astype('datetime64[ns]'), daily_values
+
+def daily_mean(obj, time_dim):
+    """6 hourly to daily means for all variables in obj
+    
+    A fast path for regular 6 hourly data. Anything else goes thru 
+    xarray's resample().
+    """
+    times = obj[time_dim].values
+    variables = {}
+    for varname, data_array in obj.data_vars.items():
+        if time_dim not in data_array.dims:
+            return obj.resample({time_dim:'1D'}).mean()
+        data_array = data_array.transpose(time_dim, *[d for d in data_array.dims if d != time_dim])
+        daily = _daily_mean_values(data_array.values, times)
+        if daily is None:
+            return obj.resample({time_dim:'1D'}).mean()
+        days, daily_values = daily
+        variables[varname] = (data_array.dims, daily_values)
+    
+    coords = {c:obj[c] for c in obj.coords if time_dim not in obj[c].dims}
+    coords[time_dim] = days
+    return xr.Dataset(variables, coords=coords, attrs=obj.attrs)
+
 # CFSv2 is has 6 hour timesteps, convert that to a daily mean
 def cfs_to_daily_mean(cfs, cfs_initial_time):
     # times in the cfs forecasts are a delta from the initial time.
@@ -185,40 +412,519 @@ def cfs_to_daily_mean(cfs, cfs_initial_time):
     cfs['forecast_time'] = date_timestamps
     
     # Aggregate to daily values instead of 6 hourly
-    cfs = cfs.resample(forecast_time='1D').mean()
+    cfs = daily_mean(cfs, time_dim='forecast_time')
     
     return cfs
 
+# lat/lon in degrees to points on a unit sphere. Distances between these
+# don't have any trouble with the CFS 0-360 longitude vs. the PRISM -180-180
+# longitude, or with the date line.
+def _lat_lon_to_xyz(lat, lon):
+    lat = np.deg2rad(lat)
+    lon = np.deg2rad(lon)
+    return np.stack([np.cos(lat)*np.cos(lon),
+                     np.cos(lat)*np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+def _target_land_mask(target_array):
+    mask_values = target_array.values
+    if mask_values.dtype == bool:
+        return mask_values
+    else:
+        return np.logical_and(np.isfinite(mask_values), mask_values != 0)
+
+class RemapOperator():
+    """Distance weighted k nearest neighbor mapping from the CFS grid to
+    the land pixels of the PRISM grid, as a sparse (land pixel, CFS cell)
+    weight matrix. 
+    
+    Applying it is a single sparse-dense matrix product over all
+    timesteps at once.
+    """
+    def __init__(self, weights, source_shape, target_shape, land_index):
+        self.weights = weights.tocsr()
+        self.source_shape = tuple(source_shape)
+        self.target_shape = tuple(target_shape)
+        self.land_index = land_index
+    
+    def apply(self, values):
+        """values is a (time, source lat, source lon) array. Returns a 
+        (time, target lat, target lon) array with nan for non-land pixels.
+        """
+        assert values.shape[1:] == self.source_shape, 'values do not match the operator source grid'
+        n_time = values.shape[0]
+        source_values = values.reshape(n_time, -1)
+        land_values = (self.weights @ source_values.T).T
+        
+        remapped = np.full((n_time, self.target_shape[0] * self.target_shape[1]), np.nan, 
+                           dtype=land_values.dtype)
+        remapped[:, self.land_index] = land_values
+        return remapped.reshape((n_time,) + self.target_shape)
+    
+    def save(self, filename):
+        tmp_filename = '{f}.{pid}.tmp.npz'.format(f=filename, pid=os.getpid())
+        np.savez(tmp_filename,
+                 data = self.weights.data,
+                 indices = self.weights.indices,
+                 indptr = self.weights.indptr,
+                 weights_shape = self.weights.shape,
+                 source_shape = self.source_shape,
+                 target_shape = self.target_shape,
+                 land_index = self.land_index)
+        os.replace(tmp_filename, filename)
+    
+    @classmethod
+    def load(cls, filename):
+        f = np.load(filename)
+        weights = sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                    shape=tuple(f['weights_shape']))
+        return cls(weights, source_shape = f['source_shape'],
+                   target_shape = f['target_shape'], land_index = f['land_index'])
+
+def build_remap_operator(source_lat, source_lon, target_array, method='distance_weighted', k=2):
+    assert method in ['nearest','distance_weighted'], 'unknown remap method: ' + str(method)
+    if method == 'nearest':
+        k = 1
+    
+    source_lon_2d, source_lat_2d = np.meshgrid(source_lon, source_lat)
+    source_xyz = _lat_lon_to_xyz(source_lat_2d.ravel(), source_lon_2d.ravel())
+    
+    land = _target_land_mask(target_array)
+    target_lon_2d, target_lat_2d = np.meshgrid(target_array.lon.values, target_array.lat.values)
+    land_index = np.flatnonzero(land)
+    target_xyz = _lat_lon_to_xyz(target_lat_2d.ravel()[land_index], target_lon_2d.ravel()[land_index])
+    
+    distances, neighbors = cKDTree(source_xyz).query(target_xyz, k=k)
+    distances = distances.reshape(len(land_index), k)
+    neighbors = neighbors.reshape(len(land_index), k)
+    
+    # Inverse distance weights. A pixel sitting exactly on a CFS cell
+    # center just gets that cell.
+    exact = distances[:,0] == 0
+    distances[exact] = 1
+    weights = 1 / distances
+    weights[exact] = 0
+    weights[exact, 0] = 1
+    weights /= weights.sum(axis=1, keepdims=True)
+    
+    rows = np.repeat(np.arange(len(land_index)), k)
+    weight_matrix = sparse.csr_matrix((weights.ravel(), (rows, neighbors.ravel())),
+                                      shape=(len(land_index), source_xyz.shape[0]))
+    
+    return RemapOperator(weight_matrix, 
+                         source_shape = (len(source_lat), len(source_lon)),
+                         target_shape = land.shape,
+                         land_index = land_index)
+
+# The source and target grids never change, so operators are kept in memory
+# and on disk, keyed by the grids and method.
+_remap_operators = {}
+
+def get_remap_operator(source_lat, source_lon, target_array, method='distance_weighted', k=2,
+                       operator_folder=None):
+    if operator_folder is None:
+        operator_folder = config['remap_operator_folder']
+    
+    key = hashlib.sha256()
+    for a in [source_lat, source_lon, target_array.lat.values, 
+              target_array.lon.values, _target_land_mask(target_array)]:
+        key.update(np.ascontiguousarray(a).tobytes())
+    key.update('{m}_{k}'.format(m=method, k=k).encode())
+    key = key.hexdigest()
+    
+    if key not in _remap_operators:
+        operator_filename = operator_folder + 'remap_' + key + '.npz'
+        if os.path.exists(operator_filename):
+            operator = RemapOperator.load(operator_filename)
+        else:
+            operator = build_remap_operator(source_lat, source_lon, target_array, 
+                                            method=method, k=k)
+            operator.save(operator_filename)
+        _remap_operators[key] = operator
+    
+    return _remap_operators[key]
+
+def source_window(source_lat, source_lon, target_array, method='distance_weighted', 
+                  k=2, halo=1):
+    """The CFS cells needed to remap to the land pixels of target_array
+    
+    Derived from the remap operator, so it includes every cell used as a
+    nearest neighbor, plus halo cells on every side. Returns lat and lon
+    index arrays for use with isel().
+    """
+    operator = get_remap_operator(source_lat, source_lon, target_array,
+                                  method=method, k=k)
+    cells_used = (operator.weights.getnnz(axis=0) > 0).reshape(operator.source_shape)
+    n_lat, n_lon = operator.source_shape
+    
+    lat_used = np.where(cells_used.any(axis=1))[0]
+    lat_index = np.arange(max(lat_used.min() - halo, 0),
+                          min(lat_used.max() + halo, n_lat - 1) + 1)
+    
+    # longitude can wrap around the edge of the array
+    lon_used = np.where(cells_used.any(axis=0))[0]
+    lon_index = np.unique([(lon_used + offset) % n_lon for offset in range(-halo, halo+1)])
+    if lon_index.max() - lon_index.min() + 1 < n_lon and not (0 in lon_index and n_lon-1 in lon_index):
+        lon_index = np.arange(lon_index.min(), lon_index.max() + 1)
+    
+    return lat_index, lon_index
+
+def crop_to_target(obj, target_array, method='distance_weighted', k=2, halo=1):
+    """Crop a CFS dataset to only the cells needed to remap onto target_array.
+    This should be done before any other processing so everything after
+    works on a much smaller array.
+    """
+    lat_index, lon_index = source_window(obj.lat.values, obj.lon.values, target_array,
+                                         method=method, k=k, halo=halo)
+    return obj.isel(lat=lat_index, lon=lon_index)
+
 # Put the CFSv2 into a finer grained array
 # This does not account for a different CRS, but actually changing the CRS results
-# in minute differences. It also doesn't explicitely account for CFS being
-# worldwide and prism being N. america. But the internals of xmap (a kdtree lookup)
-# seem to deal with this fine.
+# in minute differences. Only land pixels in the target array get values, 
+# everything else is nan. Methods other than nearest and distance_weighted
+# still go thru xmap.
+# data_var can be a single variable, a list of them, or None for all 
+# variables in ds. With more than one they are remapped together in a 
+# single pass with the same operator.
 def spatial_downscale(ds, target_array, method, data_var='tmean', 
                       time_dim='forecast_time', downscale_args={}):
     assert isinstance(target_array, xr.DataArray), 'target array must be DataArray'
-    ds_xmap = xmap.XMap(ds[data_var], debug=False)
-    ds_xmap.set_coords(x='lon',y='lat',t=time_dim)
-    downscaled = ds_xmap.remap_like(target_array, xcoord='lon', ycoord='lat',
-                                    how=method, **downscale_args)
-    return downscaled.to_dataset(name=data_var)
+    if data_var is None:
+        data_var = list(ds.data_vars)
+    if not isinstance(data_var, str):
+        return _spatial_downscale_variables(ds, target_array, method, data_var,
+                                            time_dim, downscale_args)
+    if method not in ['nearest','distance_weighted']:
+        import xmap
+        ds_xmap = xmap.XMap(ds[data_var], debug=False)
+        ds_xmap.set_coords(x='lon',y='lat',t=time_dim)
+        downscaled = ds_xmap.remap_like(target_array, xcoord='lon', ycoord='lat',
+                                        how=method, **downscale_args)
+        return downscaled.to_dataset(name=data_var)
+    
+    operator = get_remap_operator(source_lat = ds.lat.values, 
+                                  source_lon = ds.lon.values,
+                                  target_array = target_array,
+                                  method = method,
+                                  k = downscale_args.get('k', 2))
+    
+    source_values = ds[data_var].transpose(time_dim, 'lat', 'lon').values
+    downscaled = operator.apply(source_values)
+    
+    return xr.Dataset({data_var:((time_dim,'lat','lon'), downscaled)},
+                      coords = {time_dim: ds[time_dim].values,
+                                'lat': target_array.lat.values,
+                                'lon': target_array.lon.values})
+
+def _spatial_downscale_variables(ds, target_array, method, data_vars, 
+                                 time_dim, downscale_args):
+    if method not in ['nearest','distance_weighted']:
+        return xr.merge([spatial_downscale(ds, target_array, method, data_var=v,
+                                           time_dim=time_dim, downscale_args=downscale_args) for v in data_vars])
+    
+    operator = get_remap_operator(source_lat = ds.lat.values, 
+                                  source_lon = ds.lon.values,
+                                  target_array = target_array,
+                                  method = method,
+                                  k = downscale_args.get('k', 2))
+    
+    # All variables stacked along the time axis, so it's one sparse product
+    n_time = len(ds[time_dim])
+    source_values = np.concatenate([ds[v].transpose(time_dim, 'lat', 'lon').values for v in data_vars], axis=0)
+    downscaled = operator.apply(source_values)
+    
+    return xr.Dataset({v:((time_dim,'lat','lon'), downscaled[i*n_time:(i+1)*n_time]) for i, v in enumerate(data_vars)},
+                      coords = {time_dim: ds[time_dim].values,
+                                'lat': target_array.lat.values,
+                                'lon': target_array.lon.values})
+
+def _remap_and_downscale_values(operator, values, months, slope, intercept, tile_size):
+    """values is (time, source lat, source lon), months the calendar month of
+    each timestep, and slope/intercept (12, target lat, target lon). Returns
+    (time, target lat, target lon) with the downscale model applied.
+    """
+    n_time = values.shape[0]
+    source_values = values.reshape(n_time, -1).T
+    land_slope = slope.reshape(12, -1)[:, operator.land_index]
+    land_intercept = intercept.reshape(12, -1)[:, operator.land_index]
+    month_days = {m:np.where(months == m)[0] for m in np.unique(months)}
+    
+    output = np.full((n_time, operator.target_shape[0] * operator.target_shape[1]), np.nan, 
+                     dtype=values.dtype)
+    for tile_start in range(0, len(operator.land_index), tile_size):
+        tile = slice(tile_start, tile_start + tile_size)
+        tile_pixels = operator.land_index[tile]
+        # (tile pixels, time) for just these pixels
+        tile_values = (operator.weights[tile] @ source_values).T
+        for month, days in month_days.items():
+            output[days[:,None], tile_pixels] = tile_values[days] * land_slope[month-1, tile] + land_intercept[month-1, tile]
+    
+    return output.reshape((n_time,) + operator.target_shape)
+
+def remap_and_downscale(ds, target_array, model, method='distance_weighted', 
+                        data_var='tmean', time_dim='forecast_time', k=2, tile_size=20000):
+    """spatial_downscale() and the monthly downscale model in one pass
+    
+    Land pixels are done in tiles of tile_size. For each tile the remap 
+    weights are applied to the CFS cells, then each days slope and 
+    intercept, and the result written directly to the output. So no full
+    resolution intermediate arrays are made. Any other variables in ds are 
+    only remapped.
+    
+    model
+        xarray Dataset with slope and intercept (month, lat, lon) on the
+        same grid as target_array
+    """
+    assert isinstance(target_array, xr.DataArray), 'target array must be DataArray'
+    assert model.slope.shape[1:] == target_array.shape, 'downscale model does not match target array'
+    operator = get_remap_operator(source_lat = ds.lat.values, 
+                                  source_lon = ds.lon.values,
+                                  target_array = target_array,
+                                  method = method,
+                                  k = k)
+    
+    model = model.sel(month=np.arange(1,13)).transpose('month','lat','lon')
+    times = ds[time_dim].values
+    downscaled = _remap_and_downscale_values(operator,
+                                             values = ds[data_var].transpose(time_dim, 'lat', 'lon').values,
+                                             months = pd.DatetimeIndex(times).month.values,
+                                             slope = model.slope.values,
+                                             intercept = model.intercept.values,
+                                             tile_size = tile_size)
+    downscaled = xr.Dataset({data_var:((time_dim,'lat','lon'), downscaled)},
+                            coords = {time_dim: times,
+                                      'lat': target_array.lat.values,
+                                      'lon': target_array.lon.values})
+    
+    other_vars = [v for v in ds.data_vars if v != data_var]
+    if len(other_vars) > 0:
+        downscaled = xr.merge([downscaled, spatial_downscale(ds, target_array, method, data_var=other_vars,
+                                                             time_dim=time_dim, downscale_args={'k':k})])
+    return downscaled
+
+#########################################
+# Grib reading backends. Each one opens a single variable from a CFS grib
+# file and returns it with consistent names:
+#   forecast files:   varname (forecast_time, lat, lon), with forecast_time
+#                     as a timedelta from the initial time.
+#   reanalysis files: varname (time, lat, lon), with only the 0 hour 
+#                     analysis at each time.
+# Values are left in the original units. Nothing should be loaded into 
+# memory here, so that subsetting happens before any data is read.
+# New backends can be added with register_grib_backend().
+
+def _open_with_pynio(filename, variable_info, varname, file_type):
+    obj = xr.open_dataset(filename, engine='pynio')
+    obj = obj[[variable_info['cfs_nc_name']]]
+    
+    if file_type == 'forecast':
+        obj = obj.rename({'lat_0':'lat', 'lon_0':'lon', 
+                          'forecast_time0':'forecast_time',
+                          variable_info['cfs_nc_name']:varname})
+    else:
+        # Keep only the primary 6 hour timesteps
+        obj = obj.isel(forecast_time0=0).drop('forecast_time0')
+        obj = obj.rename({'lat_0':'lat', 'lon_0':'lon', 
+                          'initial_time0_hours':'time',
+                          variable_info['cfs_nc_name']:varname})
+        # Don't need these
+        obj = obj.drop([c for c in ['initial_time0_encoded', 'initial_time0'] if c in obj.variables])
+    
+    return obj
 
-def open_cfs_grib(filename):
-    return xr.open_dataset(filename, engine='pynio')
+def _open_with_cfgrib(filename, variable_info, varname, file_type):
+    obj = xr.open_dataset(filename, engine='cfgrib',
+                          backend_kwargs={'filter_by_keys':{'shortName':variable_info['cfs_grib_name']},
+                                          'indexpath':''})
+    obj = obj[[variable_info['cfs_grib_var']]]
+    obj = obj.rename({'latitude':'lat', 'longitude':'lon',
+                      variable_info['cfs_grib_var']:varname})
+    
+    if file_type == 'forecast':
+        obj = obj.rename({'step':'forecast_time'})
+    elif 'step' in obj.dims:
+        # Keep only the primary 6 hour timesteps
+        obj = obj.isel(step=0)
+    
+    # Scalar coordinates like valid_time and heightAboveGround
+    non_index_coords = [c for c in obj.coords if c not in obj.dims]
+    return obj.drop(non_index_coords)
+
+grib_backends = {'pynio':_open_with_pynio,
+                 'cfgrib':_open_with_cfgrib}
+
+def register_grib_backend(name, open_function):
+    """open_function(filename, variable_info, varname, file_type) should
+    return an xarray Dataset as described above.
+    """
+    grib_backends[name] = open_function
+
+def subset_region(obj, region):
+    """Subset to a lat/lon bounding box. region is a dictionary with
+    lat_min, lat_max, lon_min, and lon_max. Works with either 0-360 or
+    -180-180 longitudes.
+    """
+    lat = obj.lat.values
+    lon = obj.lon.values
+    lat_to_keep = np.logical_and(lat >= region['lat_min'], lat <= region['lat_max'])
+    lon_width = (region['lon_max'] - region['lon_min']) % 360
+    lon_to_keep = (lon - region['lon_min']) % 360 <= lon_width
+    return obj.isel(lat=np.where(lat_to_keep)[0], lon=np.where(lon_to_keep)[0])
+
+def open_cfs_grib(filename, file_type='forecast', varname='tmean', 
+                  region=None, backend=None):
+    """Open a single variable from a CFS grib file
+    
+    file_type
+        'forecast' or 'reanalysis'
+    
+    varname
+        an entry in variables_to_use in the config file
+    
+    region
+        lat/lon bounding box to subset to, see subset_region(). Defaults to
+        cfs_domain in the config file. Use False for the full globe.
+    
+    backend
+        one of grib_backends. Defaults to grib_backend in the config file.
+    """
+    assert file_type in ['forecast','reanalysis'], 'unknown file type: ' + str(file_type)
+    if backend is None:
+        backend = config['grib_backend']
+    if region is None:
+        region = config['cfs_domain']
+    
+    obj = grib_backends[backend](filename, 
+                                 variable_info = config['variables_to_use'][varname],
+                                 varname = varname,
+                                 file_type = file_type)
+    
+    if region:
+        obj = subset_region(obj, region)
+    
+    return obj
+
+def open_cfs_grib_variables(filenames, file_type='forecast', region=None, backend=None):
+    """Open several variables as a single Dataset
+    
+    filenames
+        dictionary of varname:filename. Variables can share a file.
+    """
+    variables = [open_cfs_grib(filename, file_type=file_type, varname=varname,
+                               region=region, backend=backend) for varname, filename in filenames.items()]
+    return xr.merge(variables, join='exact')
+
+# CFS units to the same units as PRISM, using cfs_unit_scale and 
+# cfs_unit_offset for each variable in the config file.
+def cfs_to_prism_units(obj):
+    for varname in obj.data_vars:
+        variable_info = config['variables_to_use'][varname]
+        scale = variable_info.get('cfs_unit_scale', 1)
+        offset = variable_info.get('cfs_unit_offset', 0)
+        if scale != 1:
+            obj[varname] *= scale
+        if offset != 0:
+            obj[varname] += offset
+    return obj
+
+class ForecastRejected(ValueError):
+    """A forecast which does not cover the days needed"""
+    pass
+
+class MemberPlan():
+    """What's needed from a single CFS forecast member
+    
+    The checks and selections here only use the coordinates of a lazily 
+    opened file, so they are done before any data is read.
+    
+    initial_time
+        datetime of the forecast
+    
+    first_day, last_day
+        The forecast has to cover these days, otherwise it's rejected
+    
+    keep_until
+        Last day to keep. Defaults to last_day, but can be later to keep 
+        some extra days (ie. for the member cache).
+    
+    target_array, method, k
+        The forecast is cropped to the cells needed to remap to this,
+        see crop_to_target()
+    """
+    def __init__(self, initial_time, first_day, last_day, keep_until=None,
+                 target_array=None, method='distance_weighted', k=2):
+        self.initial_time = np.datetime64(initial_time)
+        self.first_day = np.datetime64(pd.Timestamp(first_day).date())
+        self.last_day = np.datetime64(pd.Timestamp(last_day).date())
+        if keep_until is None:
+            keep_until = last_day
+        self.keep_until = np.datetime64(pd.Timestamp(keep_until).date())
+        self.target_array = target_array
+        self.method = method
+        self.k = k
+    
+    def _valid_days(self, obj):
+        valid_times = self.initial_time + obj.forecast_time.values
+        return valid_times.astype('datetime64[D]')
+    
+    def check(self, obj):
+        """Raise ForecastRejected if obj doesn't cover first_day to last_day"""
+        valid_days = self._valid_days(obj)
+        if len(valid_days) == 0:
+            raise ForecastRejected('forecast has no timesteps')
+        # If the last day of the CFS forecast is off a lot a bunch from the
+        # last day we're shooting for skip it. This happens occasionaly cause of
+        # I'm assuming, errors on NOAA's end
+        if valid_days[-1] < self.last_day:
+            raise ForecastRejected('bad forecast end date. ends on {d}'.format(d=valid_days[-1]))
+        if valid_days[0] > self.first_day:
+            raise ForecastRejected('bad forecast start date. starts on {d}'.format(d=valid_days[0]))
+    
+    def select(self, obj):
+        """Only the timesteps on first_day to keep_until, and only the 
+        cells needed for target_array."""
+        valid_days = self._valid_days(obj)
+        times_to_keep = np.logical_and(valid_days >= self.first_day, valid_days <= self.keep_until)
+        obj = obj.isel(forecast_time = np.where(times_to_keep)[0])
+        if self.target_array is not None:
+            obj = crop_to_target(obj, self.target_array, method=self.method, k=self.k)
+        return obj
 
 def convert_cfs_grib_forecast(local_filename, date, target_downscale_array=None,
                               add_initial_time_dim=True,
                               downscale_method='nearest',
-                              temp_folder=config['tmp_folder']):
-   
-    forecast_obj = open_cfs_grib(local_filename)
-    
-    # More reasonable variable names
-    forecast_obj.rename({'lat_0':'lat', 'lon_0':'lon', 
-                         'forecast_time0':'forecast_time',
-                         'TMP_P0_L103_GGA0':'tmean'}, inplace=True)
-    # Kelvin to celcius
-    forecast_obj['tmean'] -= 273.15
+                              temp_folder=config['tmp_folder'],
+                              plan=None):
+    """Open, crop, and get daily means of a CFS forecast
+    
+    local_filename
+        Either a single grib file with tmean, or a dictionary of 
+        varname:filename to convert several variables at once. All
+        variables share the cropping and time axis.
+    
+    plan
+        Optional MemberPlan. The forecast is checked against it before
+        anything is read, raising ForecastRejected if it doesn't 
+        cover the days needed. Then only the days and cells in the plan 
+        are read. target_downscale_array and downscale_method are not 
+        used with a plan.
+    """
+    if isinstance(local_filename, str):
+        local_filename = {'tmean':local_filename}
+    
+    forecast_obj = open_cfs_grib_variables(local_filename, file_type='forecast')
+    
+    if plan is not None:
+        plan.check(forecast_obj)
+        forecast_obj = plan.select(forecast_obj)
+    elif target_downscale_array is not None:
+        # Only the cells which will end up in the target array
+        forecast_obj = crop_to_target(forecast_obj, target_downscale_array,
+                                      method=downscale_method, k=2)
+    forecast_obj.load()
+    
+    # ie. Kelvin to celcius
+    forecast_obj = cfs_to_prism_units(forecast_obj)
     
     # 6 hourly timesteps to daily timesteps
     forecast_obj = cfs_to_daily_mean(cfs=forecast_obj, cfs_initial_time = date)
@@ -227,7 +933,7 @@ def convert_cfs_grib_forecast(local_filename, date, target_downscale_array=None,
         date64 = np.datetime64(date)
         # Make a new coordinate for the forecasts initial time so it can be 
         # differentiated from other forecasts
-        forecast_obj = forecast_obj['tmean'].assign_coords(initial_time=date64).expand_dims(dim='initial_time').to_dataset()
+        forecast_obj = forecast_obj.assign_coords(initial_time=date64).expand_dims(dim='initial_time')
         
         # New coordinate for the forecast lead time
         #lead_times = pd.TimedeltaIndex(forecast_obj.forecast_time - day64, freq='D')
@@ -239,25 +945,19 @@ def convert_cfs_grib_forecast(local_filename, date, target_downscale_array=None,
 def process_reanalysis(filename, date, 
                        downscale_method='nearest',
                        target_downscale_array=None):
-    obj = open_cfs_grib(filename)
-    obj.load()
+    obj = open_cfs_grib(filename, file_type='reanalysis', varname='tmean')
     
-    # Keep only the primary 6 hour timesteps
-    obj = obj.isel(forecast_time0=0).drop('forecast_time0')
-
-    # More reasonable variable names
-    obj.rename({'lat_0':'lat', 'lon_0':'lon', 
-                'initial_time0_hours':'time',
-                'TMP_P0_L103_GGA0':'tmean'}, inplace=True)
+    # Only the cells which will end up in the target array
+    if target_downscale_array is not None:
+        obj = crop_to_target(obj, target_downscale_array, 
+                             method=downscale_method, k=2)
+    obj.load()
     
     # Kelvin to celcius
-    obj['tmean'] -= 273.15
-    
-    # Don't need these
-    obj = obj.drop(['initial_time0_encoded', 'initial_time0'])
+    obj = cfs_to_prism_units(obj)
     
     # Daily means
-    obj = obj.resample(time='1D').mean()
+    obj = daily_mean(obj, time_dim='time')
     
     # ~1.0 deg cfs grid to 4km prism grid.
     if target_downscale_array is not None:
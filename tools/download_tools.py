@@ -0,0 +1,486 @@
+import os
+import time
+import heapq
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Download manager for the CFS and PRISM data. HTTP transfers go thru a
+# pool of keep-alive connections, a fixed number of worker threads do the
+# actual transfers, partial files are resumed with HTTP Range requests, and
+# failed transfers go back into the queue with a backoff wait instead of
+# blocking a worker with a sleep.
+#
+# Only the standard library is used here so the same code runs on the
+# hipergator, serenity, and against a local test server
+# (ie. python -m http.server).
+
+class RangeNotSupported(IOError):
+    """The server sent the whole file in response to a Range request"""
+    pass
+
+class ConnectionPool():
+    def __init__(self, max_per_host=4, timeout=120):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        key = (scheme, netloc)
+        with self._lock:
+            idle = self._idle.get(key, [])
+            if len(idle) > 0:
+                return idle.pop()
+
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    # Return a connection after the response was fully read, so it can
+    # be used again for the next request to the same host.
+    def release(self, scheme, netloc, con):
+        key = (scheme, netloc)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append(con)
+                return
+        con.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for con in idle:
+                    con.close()
+            self._idle = {}
+
+class DownloadManager():
+    """Concurrent, resumable file downloads
+
+    max_concurrent
+        Number of transfers to run at the same time
+
+    num_attempts
+        Default number of attempts per file before giving up
+
+    retry_wait
+        Seconds before the first retry. This doubles with every subsequent
+        attempt up to max_retry_wait.
+
+    Usage:
+        manager = DownloadManager(max_concurrent=4)
+        jobs = [manager.submit(url, dest_path) for url, dest_path in to_get]
+        statuses = manager.wait(jobs)
+
+    Statuses are 0 for success and 1 for failure, the same as the original
+    tools.download_file()
+
+    cache
+        Optional raw_file_cache.RawFileCache. Files are served from it when
+        the server metadata matches, and added to it after downloading.
+    """
+    def __init__(self, max_concurrent=4, num_attempts=3, retry_wait=30,
+                 max_retry_wait=60*10, timeout=120, chunk_size=2**20,
+                 cache=None):
+        assert max_concurrent > 0, 'max_concurrent must be > 0'
+        assert num_attempts > 0, 'num_attempts must be > 0'
+        self.max_concurrent = max_concurrent
+        self.num_attempts = num_attempts
+        self.retry_wait = retry_wait
+        self.max_retry_wait = max_retry_wait
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.cache = cache
+
+        self.pool = ConnectionPool(max_per_host=max_concurrent, timeout=timeout)
+
+        # Jobs are ordered by the time they are allowed to start, so
+        # a job waiting on a retry does not hold up any others.
+        self._queue = []
+        self._queue_counter = 0
+        self._condition = threading.Condition()
+        self._workers = []
+        self._closed = False
+
+        # Hosts which answered a Range request with the whole file
+        self._no_range_hosts = set()
+        self._no_range_lock = threading.Lock()
+
+    ##########################################
+    # Low level http
+
+    def _request(self, method, url, headers={}, max_redirects=5):
+        """Make a request, following redirects.
+
+        Returns the response along with a function to call once the
+        response has been fully read (or should be abandoned).
+        """
+        for redirect in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            con = self.pool.get(parts.scheme, parts.netloc)
+            try:
+                con.request(method, path, headers=headers)
+                response = con.getresponse()
+            except Exception:
+                con.close()
+                raise
+
+            def release(fully_read=True, con=con, response=response, parts=parts):
+                if fully_read and not response.will_close:
+                    self.pool.release(parts.scheme, parts.netloc, con)
+                else:
+                    con.close()
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                release()
+                if location is None:
+                    raise IOError('redirect without location: ' + url)
+                url = urllib.parse.urljoin(url, location)
+                if response.status == 303:
+                    method = 'GET'
+                continue
+
+            return response, release
+
+        raise IOError('too many redirects: ' + url)
+
+    def head(self, url):
+        """File metadata from the server without downloading it
+
+        Returns a dictionary with the url, size, etag, and last_modified,
+        or None if the file is not available.
+        """
+        return self.head_status(url)[1]
+
+    def head_status(self, url):
+        """head() along with the status, to tell a missing file apart from
+        a failed request. Returns (status, metadata).
+
+        status is the http status code, or None if the request itself
+        failed (ie. a timeout or connection error). ftp files which
+        don't exist get 404. metadata is None unless the status is 200.
+        """
+        scheme = urllib.parse.urlsplit(url).scheme
+        if scheme not in ['http', 'https']:
+            try:
+                response = urllib.request.urlopen(url, timeout=self.timeout)
+                size = response.headers.get('Content-Length')
+                response.close()
+            except urllib.error.URLError as e:
+                if str(e.reason).startswith('550'):
+                    return 404, None
+                return None, None
+            except Exception:
+                return None, None
+            return 200, {'url':url, 'size':int(size) if size else None,
+                         'etag':None, 'last_modified':None}
+
+        try:
+            response, release = self._request('HEAD', url)
+            response.read()
+            release()
+        except Exception:
+            return None, None
+
+        if response.status != 200:
+            return response.status, None
+
+        size = response.getheader('Content-Length')
+        return 200, {'url':url,
+                     'size':int(size) if size else None,
+                     'etag':response.getheader('ETag'),
+                     'last_modified':response.getheader('Last-Modified')}
+
+    def _range_request(self, url, start, end):
+        netloc = urllib.parse.urlsplit(url).netloc
+        with self._no_range_lock:
+            if netloc in self._no_range_hosts:
+                raise RangeNotSupported('range requests not supported: ' + url)
+
+        headers = {'Range':'bytes={s}-{e}'.format(s=start, e=end)}
+        response, release = self._request('GET', url, headers=headers)
+        if response.status == 200:
+            response.close()
+            release(fully_read=False)
+            with self._no_range_lock:
+                self._no_range_hosts.add(netloc)
+            raise RangeNotSupported('range requests not supported: ' + url)
+        elif response.status != 206:
+            response.read()
+            release()
+            raise IOError('range request failed with status {s}: {u}'.format(s=response.status, u=url))
+        return response, release
+
+    def fetch_range(self, url, start, end):
+        """Get bytes start to end (inclusive) of a remote file
+
+        If the server ignores the Range header and starts sending the
+        whole file, the connection is dropped and RangeNotSupported is 
+        raised. The host is remembered, so later calls for it raise
+        right away without making a request.
+        """
+        response, release = self._range_request(url, start, end)
+        try:
+            data = response.read()
+        except Exception:
+            release(fully_read=False)
+            raise
+        release()
+
+        if len(data) != end - start + 1:
+            raise IOError('incomplete range {s}-{e}: {u}'.format(s=start, e=end, u=url))
+        return data
+
+    def stream_range(self, url, start, end, f):
+        """Write bytes start to end (inclusive) of a remote file to the
+        open file f, chunk_size at a time. Raises the same as fetch_range(),
+        and IOError if fewer bytes were sent.
+        """
+        response, release = self._range_request(url, start, end)
+        fully_read = False
+        try:
+            self._stream_to_file(response, f, expected_size=end - start + 1)
+            fully_read = True
+        finally:
+            release(fully_read=fully_read)
+
+    def fetch(self, url):
+        """Get a small remote file, ie. an inventory, as bytes"""
+        response, release = self._request('GET', url)
+        try:
+            data = response.read()
+        except Exception:
+            release(fully_read=False)
+            raise
+        release()
+
+        if response.status != 200:
+            raise IOError('request failed with status {s}: {u}'.format(s=response.status, u=url))
+        return data
+
+    ##########################################
+    # Transfers
+
+    def _transfer(self, url, dest_path):
+        scheme = urllib.parse.urlsplit(url).scheme
+        if scheme in ['http', 'https']:
+            self._transfer_http(url, dest_path)
+        else:
+            self._transfer_other(url, dest_path)
+
+    def _stream_to_file(self, response, f, expected_size=None):
+        received = 0
+        while True:
+            chunk = response.read(self.chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            received += len(chunk)
+
+        if expected_size is not None and received != expected_size:
+            raise IOError('incomplete transfer, got {r} of {e} bytes'.format(r=received, e=expected_size))
+
+    # Partial data goes into a .part file next to the destination, which
+    # is where any later attempt picks up from. The destination path only
+    # ever holds complete files.
+    def _transfer_http(self, url, dest_path):
+        part_path = dest_path + '.part'
+        if os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+        else:
+            offset = 0
+
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={o}-'.format(o=offset)
+
+        response, release = self._request('GET', url, headers=headers)
+        fully_read = False
+        try:
+            if response.status == 416:
+                # Range not satisfiable. Either the .part file is already
+                # complete, or it's from a different version of the file.
+                response.read()
+                fully_read = True
+                content_range = response.getheader('Content-Range', '')
+                total_size = content_range.split('/')[-1]
+                if total_size.isdigit() and int(total_size) == offset:
+                    pass
+                else:
+                    os.remove(part_path)
+                    raise IOError('stale partial file removed: ' + part_path)
+            elif response.status in (200, 206):
+                content_length = response.getheader('Content-Length')
+                expected_size = int(content_length) if content_length else None
+
+                if response.status == 206:
+                    content_range = response.getheader('Content-Range', '')
+                    range_start = content_range.replace('bytes ', '').split('-')[0]
+                    if not range_start.isdigit() or int(range_start) != offset:
+                        raise IOError('unexpected Content-Range: ' + content_range)
+                    mode = 'ab'
+                else:
+                    mode = 'wb'
+
+                with open(part_path, mode) as f:
+                    self._stream_to_file(response, f, expected_size=expected_size)
+                fully_read = True
+            else:
+                response.read()
+                fully_read = True
+                raise IOError('download failed with status {s}: {u}'.format(s=response.status, u=url))
+        finally:
+            release(fully_read=fully_read)
+
+        os.replace(part_path, dest_path)
+
+    # ftp and anything else urllib can open. No resuming here.
+    def _transfer_other(self, url, dest_path):
+        part_path = dest_path + '.part'
+        response = urllib.request.urlopen(url, timeout=self.timeout)
+        try:
+            content_length = response.headers.get('Content-Length')
+            expected_size = int(content_length) if content_length else None
+            with open(part_path, 'wb') as f:
+                self._stream_to_file(response, f, expected_size=expected_size)
+        finally:
+            response.close()
+
+        os.replace(part_path, dest_path)
+
+    # Metadata used to key the cache. ftp servers don't have anything
+    # like a HEAD request, so those are cached by url only.
+    def _cache_metadata(self, url):
+        scheme = urllib.parse.urlsplit(url).scheme
+        if scheme in ['http', 'https']:
+            return self.head(url)
+        else:
+            return None
+
+    def _cached_transfer(self, url, dest_path):
+        if self.cache is None:
+            self._transfer(url, dest_path)
+            return
+
+        metadata = self._cache_metadata(url)
+        if self.cache.get(url, dest_path, metadata=metadata):
+            return
+
+        self._transfer(url, dest_path)
+        self.cache.put(url, dest_path, metadata=metadata)
+
+    def transfer(self, url, dest_path):
+        """Download a single file in the calling thread, with no retries"""
+        self._cached_transfer(url, dest_path)
+
+    ##########################################
+    # Job queue
+
+    def _start_workers(self):
+        while len(self._workers) < self.max_concurrent:
+            worker = threading.Thread(target=self._worker, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self._closed:
+                    return None
+                if len(self._queue) > 0:
+                    ready_time = self._queue[0][0]
+                    wait_time = ready_time - time.time()
+                    if wait_time <= 0:
+                        return heapq.heappop(self._queue)[2]
+                else:
+                    wait_time = None
+                self._condition.wait(wait_time)
+
+    def _enqueue(self, job, ready_time):
+        with self._condition:
+            self._queue_counter += 1
+            heapq.heappush(self._queue, (ready_time, self._queue_counter, job))
+            self._condition.notify()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            job['attempt'] += 1
+            try:
+                job['transfer'](job['url'], job['dest_path'])
+                job['status'] = 0
+            except Exception as e:
+                job['error'] = repr(e)
+                if job['attempt'] >= job['num_attempts']:
+                    job['status'] = 1
+                else:
+                    wait_time = min(self.retry_wait * 2**(job['attempt'] - 1), self.max_retry_wait)
+                    print('download attempt {a}/{n} failed for {u}, retrying in {t} sec'.format(a=job['attempt'],
+                                                                                               n=job['num_attempts'],
+                                                                                               u=job['url'],
+                                                                                               t=wait_time))
+                    self._enqueue(job, ready_time = time.time() + wait_time)
+                    continue
+
+            job['done'].set()
+
+    def submit(self, url, dest_path, num_attempts=None, transfer=None):
+        """Queue a download. Returns a job which can be passed to wait()
+
+        transfer
+            Optional function(url, dest_path) to do the download instead
+            of the usual full file transfer, ie. to get only part of it.
+            It should raise an exception on failure so it's retried.
+        """
+        if self._closed:
+            raise RuntimeError('DownloadManager is closed')
+
+        job = {'url':url,
+               'dest_path':dest_path,
+               'num_attempts':num_attempts or self.num_attempts,
+               'transfer':transfer or self._cached_transfer,
+               'attempt':0,
+               'status':None,
+               'error':None,
+               'done':threading.Event()}
+
+        self._start_workers()
+        self._enqueue(job, ready_time = time.time())
+        return job
+
+    def wait(self, jobs):
+        """Block until all jobs are finished. Returns a list of statuses"""
+        for job in jobs:
+            job['done'].wait()
+        return [job['status'] for job in jobs]
+
+    def download(self, url, dest_path, num_attempts=None):
+        job = self.submit(url, dest_path, num_attempts=num_attempts)
+        return self.wait([job])[0]
+
+    def download_all(self, urls_and_paths, num_attempts=None):
+        """Download a list of (url, dest_path) tuples. Returns a list of statuses"""
+        jobs = [self.submit(url, dest_path, num_attempts=num_attempts) for url, dest_path in urls_and_paths]
+        return self.wait(jobs)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self.pool.close()
@@ -0,0 +1,244 @@
+import os
+import json
+import struct
+import datetime
+
+from tools import download_tools
+
+# Partial downloads of CFS grib2 files. A grib2 file is just a series of
+# independent messages, one per variable/timestep, so a file with only
+# some of the timesteps can be made by fetching the byte ranges of those
+# messages and writing them one after the other.
+#
+# The byte ranges come from the .idx inventory file NCEP puts next to
+# some grib files. When there isn't one the message headers are read
+# directly from the remote file with one small range request per message.
+# Those have to be made one after the other since each message gives the
+# offset of the next, so a full 9 month forecast (~1100 messages) is
+# ~1100 round trips. Slow, but still far less data than the full file.
+# Servers which don't support range requests are found on the first one,
+# and the full file is downloaded instead.
+#
+# Messages cover the entire globe, so the spatial subsetting still
+# happens after download (see cfs_tools.open_cfs_grib()).
+
+# Grib2 code table 4.4, unit of time range, in hours
+_time_unit_hours = {0:1/60, 1:1, 2:24, 10:3, 11:6, 12:12, 13:1/3600}
+
+##########################################
+# .idx inventory files
+# Lines look like:
+#   1:0:d=2018021518:TMP:2 m above ground:anl:
+#   2:169733:d=2018021518:TMP:2 m above ground:6 hour fcst:
+
+def _idx_forecast_hour(forecast_str):
+    if forecast_str == 'anl':
+        return 0
+    parts = forecast_str.split(' ')
+    if len(parts) == 3 and parts[2] == 'fcst':
+        if parts[1] == 'hour':
+            return int(parts[0])
+        elif parts[1] == 'day':
+            return int(parts[0]) * 24
+    raise ValueError('unknown forecast time in idx: ' + forecast_str)
+
+def parse_idx(idx_text, file_size):
+    """Inventory from the text of a .idx file. Lines which can't be parsed
+    raise a ValueError.
+    """
+    lines = [l for l in idx_text.splitlines() if l.strip()]
+    offsets = [int(l.split(':')[1]) for l in lines]
+    ends = offsets[1:] + [file_size]
+
+    inventory = []
+    for line, offset, end in zip(lines, offsets, ends):
+        fields = line.split(':')
+        inventory.append({'offset':offset,
+                          'length':end - offset,
+                          'forecast_hour':_idx_forecast_hour(fields[5])})
+    return inventory
+
+##########################################
+# Reading the message headers directly
+
+def _parse_section_4(section):
+    # Octets 18 and 19-22 (1 based) in product definition templates 4.0
+    # and 4.8 are the unit and the forecast time. For 4.8 (averages and
+    # accumulations) this is the start of the period.
+    template = struct.unpack('>H', section[7:9])[0]
+    if template not in [0, 1, 8, 11]:
+        raise ValueError('unsupported product definition template: ' + str(template))
+    unit = section[17]
+    forecast_time = struct.unpack('>I', section[18:22])[0]
+    return forecast_time * _time_unit_hours[unit]
+
+def _message_forecast_hour(header, offset):
+    # Sections 1-4 are all small and come before the data, so the header
+    # should have them all.
+    position = 16
+    while position + 5 <= len(header):
+        section_length, section_number = struct.unpack('>IB', header[position:position+5])
+        if section_number == 4:
+            if position + section_length > len(header):
+                break
+            return _parse_section_4(header[position:position + section_length])
+        position += section_length
+    raise ValueError('no product definition section in the header of the message at byte ' + str(offset))
+
+def scan_grib2_headers(fetch_range, file_size, header_bytes=8192):
+    """Inventory by reading the headers of each message, with a single
+    request of header_bytes per message.
+
+    fetch_range
+        function(start, end) returning bytes start-end (inclusive) of
+        the file, ie. DownloadManager.fetch_range with the url filled in.
+    """
+    inventory = []
+    offset = 0
+    while offset < file_size:
+        header = fetch_range(offset, min(offset + header_bytes, file_size) - 1)
+        if header[:4] != b'GRIB' or header[7] != 2:
+            raise ValueError('not a grib2 message at byte ' + str(offset))
+        message_length = struct.unpack('>Q', header[8:16])[0]
+        inventory.append({'offset':offset,
+                          'length':message_length,
+                          'forecast_hour':_message_forecast_hour(header[:message_length], offset)})
+        offset += message_length
+    return inventory
+
+##########################################
+
+def get_inventory(manager, url, file_info=None):
+    """Inventory of messages in a remote grib2 file, from the .idx file
+    if there is one, otherwise by reading the headers.
+
+    file_info
+        From manager.head(url), if it was already done
+
+    Returns a list of dictionaries with offset, length, and forecast_hour
+    """
+    if file_info is None:
+        file_info = manager.head(url)
+    if file_info is None or file_info['size'] is None:
+        raise IOError('file size not available: ' + url)
+
+    try:
+        idx_text = manager.fetch(url + '.idx').decode('utf-8')
+    except IOError:
+        idx_text = None
+
+    if idx_text is not None:
+        return parse_idx(idx_text, file_info['size'])
+    else:
+        fetch_range = lambda start, end: manager.fetch_range(url, start, end)
+        return scan_grib2_headers(fetch_range, file_info['size'])
+
+def select_byte_ranges(inventory, initial_time, first_day, last_day):
+    """Byte ranges (start, end inclusive) for the messages with valid times
+    on days first_day to last_day. Adjacent messages are merged into a
+    single range.
+    """
+    first_day = first_day.date() if isinstance(first_day, datetime.datetime) else first_day
+    last_day  = last_day.date() if isinstance(last_day, datetime.datetime) else last_day
+
+    ranges = []
+    for message in inventory:
+        valid_time = initial_time + datetime.timedelta(hours=message['forecast_hour'])
+        if not first_day <= valid_time.date() <= last_day:
+            continue
+        start = message['offset']
+        end = message['offset'] + message['length'] - 1
+        if len(ranges) > 0 and ranges[-1][1] + 1 == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+# The byte ranges of a partial download are kept next to the .part file,
+# so a later attempt can pick up where the last one stopped. It's only
+# used if the remote file and the days wanted are the same.
+def _ranges_filename(dest_path):
+    return dest_path + '.ranges'
+
+def _read_ranges(dest_path):
+    try:
+        with open(_ranges_filename(dest_path), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def _write_ranges(ranges_info, dest_path):
+    tmp_filename = '{f}.{pid}.tmp'.format(f=_ranges_filename(dest_path), pid=os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(ranges_info, f)
+    os.replace(tmp_filename, _ranges_filename(dest_path))
+
+def _remove_partial_files(dest_path):
+    for f in [dest_path + '.part', _ranges_filename(dest_path)]:
+        if os.path.exists(f):
+            os.remove(f)
+
+def partial_transfer(manager, initial_time, first_day, last_day):
+    """A transfer function for DownloadManager.submit() which only gets
+    the forecast days first_day to last_day. If the inventory can't be
+    made, or the server doesn't do range requests, the full file is 
+    downloaded instead.
+
+    Ranges are streamed to dest_path + '.part', and a failed attempt is
+    resumed from there by the next one, the same as full downloads.
+
+    Partial files are not added to the raw file cache since they
+    depend on the days requested.
+    """
+    def full_transfer(url, dest_path, reason):
+        print('{r} for {u}, getting the full file.'.format(r=reason, u=url))
+        _remove_partial_files(dest_path)
+        manager.transfer(url, dest_path)
+
+    def transfer(url, dest_path):
+        file_info = manager.head(url)
+        ranges_key = {'url':url,
+                      'size':file_info['size'] if file_info else None,
+                      'etag':file_info['etag'] if file_info else None,
+                      'days':[str(initial_time), str(first_day), str(last_day)]}
+        
+        part_path = dest_path + '.part'
+        previous = _read_ranges(dest_path)
+        if previous is not None and previous['key'] == ranges_key and os.path.exists(part_path):
+            ranges = [tuple(r) for r in previous['ranges']]
+            already_written = os.path.getsize(part_path)
+        else:
+            _remove_partial_files(dest_path)
+            try:
+                inventory = get_inventory(manager, url, file_info=file_info)
+            except (IOError, ValueError, KeyError) as e:
+                full_transfer(url, dest_path, 'no grib inventory ({e})'.format(e=repr(e)))
+                return
+            ranges = select_byte_ranges(inventory, initial_time, first_day, last_day)
+            if len(ranges) == 0:
+                raise IOError('no forecast days in range: ' + url)
+            _write_ranges({'key':ranges_key, 'ranges':ranges}, dest_path)
+            already_written = 0
+
+        # Ranges are written one after the other, so the size of the .part
+        # file says where to start.
+        try:
+            with open(part_path, 'ab') as f:
+                position = 0
+                for start, end in ranges:
+                    range_length = end - start + 1
+                    if already_written < position + range_length:
+                        skip = max(already_written - position, 0)
+                        manager.stream_range(url, start + skip, end, f)
+                    position += range_length
+        except download_tools.RangeNotSupported:
+            full_transfer(url, dest_path, 'no range requests')
+            return
+
+        if os.path.getsize(part_path) != position:
+            _remove_partial_files(dest_path)
+            raise IOError('partial file is the wrong size, removed: ' + part_path)
+        os.replace(part_path, dest_path)
+        os.remove(_ranges_filename(dest_path))
+
+    return transfer
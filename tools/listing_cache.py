@@ -0,0 +1,117 @@
+import os
+import time
+import json
+import hashlib
+import threading
+
+from tools import tools
+
+# FTP folder listings kept on disk, so they are shared between processes
+# (ie. MPI workers) and between runs. Each folder has its own time to live,
+# set by the caller: long for folders which don't change anymore, short for
+# ones which are still being added to.
+#
+# Stale entries can either be refreshed right away, or returned as is while
+# a background thread refreshes them for next time.
+
+# Background refresh threads from all caches in this process, so they
+# can be waited on before forking (see wait_for_background_refreshes()).
+_background_threads = set()
+_background_threads_lock = threading.Lock()
+
+def wait_for_background_refreshes(timeout=None):
+    """Wait for any background refreshes to finish. Returns True if none
+    are left running."""
+    with _background_threads_lock:
+        threads = list(_background_threads)
+    for thread in threads:
+        thread.join(timeout)
+    return not any(thread.is_alive() for thread in threads)
+
+class FolderListingCache():
+    def __init__(self, cache_folder, namespace):
+        self.cache_folder = cache_folder
+        self.namespace = namespace
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def _filename(self, folder):
+        folder_hash = hashlib.sha256(folder.encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.cache_folder, self.namespace + '_' + folder_hash + '.json')
+
+    def _read(self, folder):
+        try:
+            with open(self._filename(folder), 'r') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        # Guard against hash collisions
+        if entry.get('folder') != folder:
+            return None
+        return entry
+
+    def _write(self, folder, listing):
+        filename = self._filename(folder)
+        tmp_filename = '{f}.{pid}.{t}.tmp'.format(f=filename, pid=os.getpid(), t=threading.get_ident())
+        with open(tmp_filename, 'w') as f:
+            json.dump({'folder':folder, 'fetched':time.time(), 'listing':listing}, f)
+        os.replace(tmp_filename, filename)
+
+    def _refresh(self, folder, ttl, fetch):
+        # Only one process fetches a folder at a time. Any others waiting on
+        # the lock will find the fresh entry once they get it.
+        with tools.file_lock(self._filename(folder)):
+            entry = self._read(folder)
+            if entry is not None and time.time() - entry['fetched'] < ttl:
+                return entry['listing']
+            listing = fetch(folder)
+            self._write(folder, listing)
+            return listing
+
+    def _refresh_in_background(self, folder, ttl, fetch):
+        with self._refreshing_lock:
+            if folder in self._refreshing:
+                return
+            self._refreshing.add(folder)
+
+        def refresh():
+            try:
+                self._refresh(folder, ttl, fetch)
+            except Exception as e:
+                print('background refresh of {f} failed: {e}'.format(f=folder, e=repr(e)))
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(folder)
+                with _background_threads_lock:
+                    _background_threads.discard(threading.current_thread())
+
+        thread = threading.Thread(target=refresh, daemon=True)
+        with _background_threads_lock:
+            _background_threads.add(thread)
+        thread.start()
+
+    def get(self, folder, ttl, fetch, refresh_in_background=False):
+        """The listing of folder
+
+        ttl
+            seconds a cached listing is good for
+
+        fetch
+            function which takes the folder and returns the listing from
+            the server.
+
+        refresh_in_background
+            If True, a stale listing is returned right away and fetch is
+            run in a separate thread. So fetch must be safe to run in a
+            different thread (ie. use its own connection).
+        """
+        entry = self._read(folder)
+        if entry is not None:
+            if time.time() - entry['fetched'] < ttl:
+                return entry['listing']
+            elif refresh_in_background:
+                self._refresh_in_background(folder, ttl, fetch)
+                return entry['listing']
+
+        return self._refresh(folder, ttl, fetch)
@@ -2,6 +2,58 @@ import pandas as pd
 import numpy as np
 import xarray as xr
 from pyPhenology import utils
+from tools import tools
+
+class RunningMoments():
+    """Per pixel mean and standard deviation over an ensemble, updated one
+    member at a time (Welford's method) so members don't all have to be 
+    in memory. nan values are skipped, the same as np.nanmean and 
+    np.nanstd.
+    """
+    def __init__(self):
+        self.count = None
+        self._mean = None
+        self._m2 = None
+    
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.count is None:
+            self.count = np.zeros(values.shape)
+            self._mean = np.zeros(values.shape)
+            self._m2 = np.zeros(values.shape)
+        
+        has_value = ~np.isnan(values)
+        self.count += has_value
+        delta = np.where(has_value, values - self._mean, 0)
+        self._mean += np.divide(delta, self.count, out=np.zeros(values.shape), where=self.count>0)
+        self._m2 += np.where(has_value, delta * (values - self._mean), 0)
+    
+    def mean(self):
+        return np.where(self.count > 0, self._mean, np.nan)
+    
+    def sd(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, np.sqrt(self._m2 / self.count), np.nan)
+
+def predict_member(model, climate, doy_0, aggregation='mean', n_jobs=1):
+    """Predict a phenology model for a single climate member, with nan
+    for no prediction.
+    """
+    doy_series =  pd.TimedeltaIndex(climate.time.values - doy_0, freq='D').days.values
+    if aggregation == 'none':
+        prediction = model.predict(predictors={'temperature': climate.tmean.values,
+                                               'doy_series' : doy_series},
+                                   aggregation='none',
+                                   n_jobs=n_jobs)
+    else:
+        prediction = model.predict(predictors={'temperature': climate.tmean.values,
+                                               'doy_series' : doy_series},
+                                   n_jobs=n_jobs)
+    
+    prediction = np.array(prediction).astype(float)
+    # apply nan to non predictions
+    prediction[prediction==999]=np.nan
+    return prediction
 
 def predict_phenology_from_climate(model, climate_forecast_files, post_process, 
                           doy_0, species_range=None, n_jobs=1):
@@ -10,8 +62,10 @@ def predict_phenology_from_climate(model, climate_forecast_files, post_process,
     model
         A saved model file, or pyPhenology object
     
-    climate_forecasts
-        A list of xarray objects. each one a climate forecast
+    climate_forecast_files
+        A list of climate member files, see tools.open_climate_member(),
+        or an iterable of xarray objects. With 'automated' they are used
+        one at a time, so this can be a generator.
         
     post_process
         How to deal with multiple forecasts and/or bootstraps
@@ -41,35 +95,24 @@ def predict_phenology_from_climate(model, climate_forecast_files, post_process,
         model = utils.load_saved_model(model)
     
     
-    species_ensemble = []
-    for climate_file in climate_forecast_files:
-        climate = xr.open_dataset(climate_file)
-        doy_series =  pd.TimedeltaIndex(climate.time.values - doy_0, freq='D').days.values
-        
-        # When using a bootstrap model in hindcasting we want *all*
-        # the predictions. Otherwise just the mean will do
-        if type(model).__name__ == 'BootstrapModel' and post_process=='hindcast':
-            species_ensemble.append(model.predict(predictors={'temperature': climate.tmean.values,
-                                                              'doy_series' : doy_series},
-                                                  aggregation='none',
-                                                  n_jobs=n_jobs))
-        else:
-            species_ensemble.append(model.predict(predictors={'temperature': climate.tmean.values,
-                                                              'doy_series' : doy_series},
-                                                  n_jobs=n_jobs))
-    
-    species_ensemble = np.array(species_ensemble).astype(np.float)
-    # apply nan to non predictions
-    species_ensemble[species_ensemble==999]=np.nan
-    
-    # Keep only values in the range
-    if species_range:
-        species_ensemble[:,~species_range.range.values]=np.nan
+    def climate_members():
+        for climate in climate_forecast_files:
+            if isinstance(climate, str):
+                climate = tools.open_climate_member(climate)
+            yield climate
     
+    # The ensemble mean and sd are updated with each member, so only 
+    # one member prediction is in memory at a time.
     if post_process == 'automated':
-    
-        prediction_doy = np.nanmean(species_ensemble, axis=0)
-        prediction_sd = np.nanstd(species_ensemble, axis=0)
+        ensemble_moments = RunningMoments()
+        for climate in climate_members():
+            prediction = predict_member(model, climate, doy_0, n_jobs=n_jobs)
+            if species_range:
+                prediction[~species_range.range.values]=np.nan
+            ensemble_moments.add(prediction)
+        
+        prediction_doy = ensemble_moments.mean()
+        prediction_sd = ensemble_moments.sd()
         
         # extend the axis by 2 to match the xarray creation
         prediction_doy= np.expand_dims(prediction_doy, axis=0)
@@ -78,7 +121,21 @@ def predict_phenology_from_climate(model, climate_forecast_files, post_process,
         prediction_sd = np.expand_dims(prediction_sd, axis=0)
     
         return prediction_doy, prediction_sd
-        
-    elif post_process == 'hindcast':
-        return species_ensemble
+    
+    species_ensemble = []
+    for climate in climate_members():
+        # When using a bootstrap model in hindcasting we want *all*
+        # the predictions. Otherwise just the mean will do
+        if type(model).__name__ == 'BootstrapModel':
+            species_ensemble.append(predict_member(model, climate, doy_0, aggregation='none', n_jobs=n_jobs))
+        else:
+            species_ensemble.append(predict_member(model, climate, doy_0, n_jobs=n_jobs))
+    
+    species_ensemble = np.array(species_ensemble)
+    
+    # Keep only values in the range
+    if species_range:
+        species_ensemble[:,~species_range.range.values]=np.nan
+    
+    return species_ensemble
 
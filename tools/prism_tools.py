@@ -6,7 +6,7 @@ import os
 import zipfile
 import time
 import urllib
-from tools import tools
+from tools import tools, tracing, listing_cache
 
 config = tools.load_config()
 
@@ -21,13 +21,19 @@ class prism_ftp_info:
         
         self.base_dir=base_dir
         self._folder_file_lists={}
+        self._listing_cache = listing_cache.FolderListingCache(config['listing_cache_folder'],
+                                                               namespace='prism_'+host)
         
-        self.connect()
+        # Connecting is put off until a folder listing is actually needed,
+        # which may not happen if they're all in the listing cache.
+        self.con = None
     
     def _query_ftp_folder(self, folder, attempts_made=0):
         connect_attempts=5
         retry_wait_time=300
         try:
+            if self.con is None:
+                self.connect()
             dir_listing = self.con.nlst(folder)
             return dir_listing
         except:
@@ -45,14 +51,42 @@ class prism_ftp_info:
         self.con = FTP(host=self.host, user=self.user, passwd=self.passwd)
 
     def close(self):
-        self.con.close()
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+    
+    # For refreshing listings in a background thread, which can't 
+    # share self.con
+    def _query_ftp_folder_new_connection(self, folder):
+        con = FTP(host=self.host, user=self.user, passwd=self.passwd)
+        try:
+            return con.nlst(folder)
+        finally:
+            con.close()
+    
+    # Folders for years which are more than 6 months past are closed, ie.
+    # everything in them is stable and nothing else will be added. Those
+    # are rarely re-listed, and when they are it's done in the background.
+    # The current year is re-listed often.
+    def _folder_is_closed(self, folder):
+        year = int(folder.strip('/').split('/')[-1])
+        end_of_year = datetime.datetime(year, 12, 31)
+        return datetime.datetime.today() - end_of_year > datetime.timedelta(days=183)
         
     #Ensure that each folder is only queried once
     def _get_folder_listing(self, folder):
         if folder in self._folder_file_lists:
             return self._folder_file_lists[folder]
         else:
-            dir_listing = self._query_ftp_folder(folder)
+            if self._folder_is_closed(folder):
+                dir_listing = self._listing_cache.get(folder, 
+                                                      ttl = config['listing_cache_ttl_hours']['closed']*3600,
+                                                      fetch = self._query_ftp_folder_new_connection,
+                                                      refresh_in_background = True)
+            else:
+                dir_listing = self._listing_cache.get(folder, 
+                                                      ttl = config['listing_cache_ttl_hours']['current']*3600,
+                                                      fetch = self._query_ftp_folder)
             self._folder_file_lists[folder]=dir_listing
             return dir_listing
 
@@ -118,18 +152,33 @@ def prism_to_xarray(bil_filename, varname, date, status, mask_value=-9999):
 
     return xr_dataset
 
-# Download a file for a particualar day and convert to an
-# xarray object for inclusion in main dataset
-def download_and_process_day(download_url, date, varname, status):
-    dest_path  = config['tmp_folder']+os.path.basename(download_url)
-    tools.download_file(download_path=download_url,
-                        dest_path=dest_path)
+def local_zip_filename(download_url):
+    return config['tmp_folder']+os.path.basename(download_url)
+
+# Download several days at once. Returns a list of download statuses,
+# 0 for success and 1 for failure, in the same order as download_urls.
+@tracing.traced('prism_download')
+def download_days(download_urls):
+    manager = tools.download_manager()
+    return manager.download_all([(url, local_zip_filename(url)) for url in download_urls])
+
+# Convert an already downloaded day zip file to an xarray object
+@tracing.traced('prism_process_day')
+def process_day(download_url, date, varname, status):
+    dest_path  = local_zip_filename(download_url)
     z = zipfile.ZipFile(dest_path, 'r')
     z.extractall(path = config['tmp_folder'])
     z.close()
     bil_filename = dest_path.split('.')[0]+'.bil'
     return prism_to_xarray(bil_filename, varname=varname, date=date, status=status)
 
+# Download a file for a particualar day and convert to an
+# xarray object for inclusion in main dataset
+def download_and_process_day(download_url, date, varname, status):
+    tools.download_file(download_path=download_url,
+                        dest_path=local_zip_filename(download_url))
+    return process_day(download_url, date=date, varname=varname, status=status)
+
 # PRISM file status are stable > provisional > early
 def newer_file_available(current_status, available_status):
     if current_status == available_status:
@@ -0,0 +1,192 @@
+import os
+import time
+import json
+import shutil
+import hashlib
+
+# A persistent cache for the raw CFS grib and PRISM zip files, so re-runs
+# and hindcast backfills don't download the same multi-GB files again.
+#
+# Layout inside the cache folder:
+#   blobs/ab/abcd...  file contents, named by their sha256
+#   keys/<hash>.json  url + server metadata -> blob
+#   urls/<hash>.json  url -> most recent key, used when the server
+#                     metadata is not available
+#
+# Entries are looked up by the url along with the server metadata
+# (etag, last modified, size), so a file which changed on the server
+# is not served from the cache. The least recently used blobs are
+# removed once the total size goes over max_size_gb.
+#
+# Blobs are copies, never links to the downloaded file, so they can be made
+# read only without changing the caller's file. Their checksum is verified
+# when they are added, after that only the size is checked on each lookup,
+# and the full checksum again once it's more than reverify_days old.
+
+def _hash_string(s):
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+def file_sha256(filename, chunk_size=2**20):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+# Write to a temporary file and move into place so other processes
+# never see a partially written file.
+def _atomic_write_json(obj, filename):
+    tmp_filename = '{f}.{pid}.tmp'.format(f=filename, pid=os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_filename, filename)
+
+def _read_json(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+# Hard link when possible, otherwise copy.
+def _link_or_copy(src, dest):
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+class RawFileCache():
+    def __init__(self, cache_folder, max_size_gb=100, verify_checksum=True, reverify_days=30):
+        self.cache_folder = cache_folder
+        self.max_size = int(max_size_gb * 1024**3)
+        self.verify_checksum = verify_checksum
+        self.reverify_after = reverify_days * 24 * 3600
+
+        for subfolder in ['blobs','keys','urls']:
+            os.makedirs(os.path.join(cache_folder, subfolder), exist_ok=True)
+
+    def _key(self, url, metadata):
+        if metadata is None:
+            metadata = {}
+        key_parts = [url] + [str(metadata.get(m)) for m in ['etag','last_modified','size']]
+        return _hash_string('|'.join(key_parts))
+
+    def _key_filename(self, key):
+        return os.path.join(self.cache_folder, 'keys', key + '.json')
+
+    def _url_filename(self, url):
+        return os.path.join(self.cache_folder, 'urls', _hash_string(url) + '.json')
+
+    def _blob_filename(self, sha256):
+        return os.path.join(self.cache_folder, 'blobs', sha256[:2], sha256)
+
+    def lookup(self, url, metadata=None):
+        """Path to the cached file for url, or None if it's not cached
+
+        metadata
+            dictionary with etag, last_modified, and size from the server
+            (see DownloadManager.head()). If None the most recently
+            cached version of the url is used.
+        """
+        if metadata is None:
+            pointer = _read_json(self._url_filename(url))
+            if pointer is None:
+                return None
+            key = pointer['key']
+        else:
+            key = self._key(url, metadata)
+
+        entry = _read_json(self._key_filename(key))
+        if entry is None:
+            return None
+
+        blob_filename = self._blob_filename(entry['sha256'])
+        if not os.path.exists(blob_filename):
+            return None
+
+        # Integrity checks. A bad blob is removed so it gets downloaded again.
+        verified = entry.get('verified', entry['stored'])
+        reverify = self.verify_checksum and time.time() - verified > self.reverify_after
+        if os.path.getsize(blob_filename) != entry['size'] or \
+           (reverify and file_sha256(blob_filename) != entry['sha256']):
+            print('Removing corrupt cache entry for ' + url)
+            os.remove(blob_filename)
+            return None
+        if reverify:
+            entry['verified'] = time.time()
+            _atomic_write_json(entry, self._key_filename(key))
+
+        # Access time for the LRU eviction
+        os.utime(blob_filename)
+        return blob_filename
+
+    def get(self, url, dest_path, metadata=None):
+        """Put the cached version of url at dest_path. Returns True if it was
+        in the cache, False otherwise.
+        """
+        blob_filename = self.lookup(url, metadata=metadata)
+        if blob_filename is None:
+            return False
+
+        _link_or_copy(blob_filename, dest_path)
+        return True
+
+    def put(self, url, src_path, metadata=None):
+        """Add a downloaded file to the cache"""
+        # The checksum is of the copy, so it's verified as written
+        tmp_filename = os.path.join(self.cache_folder, 'blobs',
+                                    '{h}.{pid}.tmp'.format(h=_hash_string(url), pid=os.getpid()))
+        shutil.copyfile(src_path, tmp_filename)
+        sha256 = file_sha256(tmp_filename)
+        size = os.path.getsize(tmp_filename)
+
+        blob_filename = self._blob_filename(sha256)
+        if not os.path.exists(blob_filename):
+            os.makedirs(os.path.dirname(blob_filename), exist_ok=True)
+            # Blobs are shared with hard links by get(), so make sure
+            # nothing writes into them.
+            os.chmod(tmp_filename, 0o444)
+            os.replace(tmp_filename, blob_filename)
+        else:
+            os.remove(tmp_filename)
+            os.utime(blob_filename)
+
+        key = self._key(url, metadata)
+        _atomic_write_json({'url':url, 'metadata':metadata,
+                            'sha256':sha256, 'size':size,
+                            'stored':time.time(), 'verified':time.time()}, self._key_filename(key))
+        _atomic_write_json({'url':url, 'key':key}, self._url_filename(url))
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used files until under the size budget"""
+        blobs = []
+        for root, dirs, files in os.walk(os.path.join(self.cache_folder, 'blobs')):
+            for f in files:
+                if f.endswith('.tmp'):
+                    continue
+                blob_filename = os.path.join(root, f)
+                try:
+                    stat = os.stat(blob_filename)
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, blob_filename))
+
+        total_size = sum([b[1] for b in blobs])
+        for mtime, size, blob_filename in sorted(blobs):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(blob_filename)
+            except OSError:
+                pass
+            total_size -= size
+
+        # Key entries pointing to removed blobs just fail the lookup,
+        # they are small so they're left alone.
@@ -0,0 +1,148 @@
+import os
+import json
+import contextlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array as da
+
+from tools import tools
+
+# All the downscaled CFS reanalysis in a single zarr store, with chunks
+# laid out for reading the full time series of small blocks of pixels
+# (which is how the downscaling models are built).
+#
+# The store is created up front with the full daily time axis, then the
+# reanalysis workers write each month into its own time region. A month
+# can span two time chunks, and writing part of a chunk means reading and
+# re-writing all of it, so writes are done while holding a lock on each
+# time chunk involved. A manifest records which months are done, along
+# with the layout the store was created with.
+
+def _manifest_filename(store_folder):
+    return store_folder.rstrip('/') + '_manifest.json'
+
+def _time_chunk_lock_filename(store_folder, chunk_i):
+    return store_folder.rstrip('/') + '_time_chunk_{i}'.format(i=chunk_i)
+
+def _grid_description(coord):
+    coord = np.asarray(coord)
+    return {'size':len(coord), 'first':float(coord[0]), 'last':float(coord[-1])}
+
+def _layout(time, lat, lon, chunks):
+    return {'begin_date':str(time[0].date()),
+            'end_date':str(time[-1].date()),
+            'lat':_grid_description(lat),
+            'lon':_grid_description(lon),
+            'chunks':{d:int(chunks[d]) for d in ['time','lat','lon']}}
+
+def _layout_differences(existing, requested):
+    differences = []
+    for attr, value in requested.items():
+        # Manifests from before the layout was recorded only have begin_date
+        if attr not in existing:
+            continue
+        if attr in ['lat','lon']:
+            same = existing[attr]['size'] == value['size'] and \
+                   np.isclose(existing[attr]['first'], value['first']) and \
+                   np.isclose(existing[attr]['last'], value['last'])
+        else:
+            same = existing[attr] == value
+        if not same:
+            differences.append('{a}: store has {e}, requested {r}'.format(a=attr, e=existing[attr], r=value))
+    return differences
+
+def create_store(store_folder, begin_date, end_date, lat, lon, chunks):
+    """Make an empty store covering begin_date to end_date, daily.
+    Only the metadata and coordinates are written here. If the store
+    already exists with the same dates, lat/lon, and chunks nothing is 
+    done, if it's different a ValueError is raised.
+
+    chunks
+        dictionary with chunk sizes for time, lat, and lon
+    """
+    time = pd.date_range(begin_date, end_date, freq='1D')
+    layout = _layout(time, lat, lon, chunks)
+
+    manifest_filename = _manifest_filename(store_folder)
+    with tools.file_lock(manifest_filename):
+        if os.path.exists(manifest_filename):
+            differences = _layout_differences(read_manifest(store_folder), layout)
+            if len(differences) > 0:
+                raise ValueError('existing store {s} has a different layout, remove it to start over. '.format(s=store_folder) + \
+                                 '; '.join(differences))
+            return
+
+        shape = (len(time), len(lat), len(lon))
+        chunk_shape = (chunks['time'], chunks['lat'], chunks['lon'])
+        empty = da.full(shape, np.nan, dtype=np.float32, chunks=chunk_shape)
+
+        store = xr.Dataset({'tmean':(('time','lat','lon'), empty)},
+                           coords = {'time':time, 'lat':lat, 'lon':lon})
+        store.to_zarr(store_folder, mode='w', compute=False,
+                      encoding={'tmean':{'chunks':chunk_shape}})
+
+        manifest = {'time_chunk_size':chunks['time'],
+                    'completed_months':[]}
+        manifest.update(layout)
+        _write_manifest(manifest, store_folder)
+
+# Workers read the manifest while others update it, so it's
+# always replaced in one go.
+def _write_manifest(manifest, store_folder):
+    manifest_filename = _manifest_filename(store_folder)
+    tmp_filename = '{f}.{pid}.tmp'.format(f=manifest_filename, pid=os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_filename, manifest_filename)
+
+def read_manifest(store_folder):
+    return tools.read_json(_manifest_filename(store_folder))
+
+def completed_months(store_folder):
+    """Set of months (as YYYYMM strings) already written to the store"""
+    return set(read_manifest(store_folder)['completed_months'])
+
+def write_month(store_folder, obj, month):
+    """Write one month of daily data into the store
+
+    obj
+        xarray Dataset with tmean (time, lat, lon) on the same lat/lon
+        grid as the store.
+
+    month
+        YYYYMM string to record in the manifest
+    """
+    manifest = read_manifest(store_folder)
+    begin_date = np.datetime64(manifest['begin_date'])
+    time_chunk_size = manifest['time_chunk_size']
+
+    time_index = ((obj.time.values - begin_date) // np.timedelta64(1, 'D')).astype(int)
+    assert np.all(np.diff(time_index) == 1), 'days in month {m} are not contiguous'.format(m=month)
+    region_start, region_end = time_index[0], time_index[-1] + 1
+
+    to_write = obj[['tmean']].transpose('time','lat','lon').astype(np.float32)
+    to_write = to_write.drop_vars(['lat','lon'])
+
+    # Lock every time chunk this month touches, always in the same order
+    # so two workers can't deadlock.
+    time_chunks = range(region_start // time_chunk_size, (region_end - 1) // time_chunk_size + 1)
+    with contextlib.ExitStack() as locks:
+        for i in time_chunks:
+            locks.enter_context(tools.file_lock(_time_chunk_lock_filename(store_folder, i)))
+        to_write.to_zarr(store_folder, region={'time':slice(region_start, region_end)})
+
+    with tools.file_lock(_manifest_filename(store_folder)):
+        manifest = read_manifest(store_folder)
+        manifest['completed_months'] = sorted(set(manifest['completed_months']) | set([month]))
+        _write_manifest(manifest, store_folder)
+
+def open_store(store_folder, only_completed=True):
+    """Open the store lazily. By default only the days in completed
+    months are included.
+    """
+    store = xr.open_zarr(store_folder)
+    if only_completed:
+        months = pd.DatetimeIndex(store.time.values).strftime('%Y%m')
+        store = store.isel(time=np.isin(months, list(completed_months(store_folder))))
+    return store
@@ -4,11 +4,23 @@ import urllib
 import time
 import yaml
 import json
+import types
+import shlex
+import gzip
+import shutil
+import threading
+import collections.abc
+import contextlib
+import fcntl
+import csv
 import numpy as np
 import pandas as pd
+import xarray as xr
 
 from fabric import Connection
 
+from tools import download_tools, raw_file_cache
+
 def string_to_date(s, h=False):
     assert isinstance(s, str) ,'date not a string'
     if h:
@@ -25,17 +37,30 @@ def date_to_string(d, h=False):
     else:
         return d.strftime('%Y%m%d')
 
+# A process wide download manager, so connections and the raw file
+# cache are shared among everything downloading files.
+_download_manager = None
+
+def download_manager():
+    global _download_manager
+    if _download_manager is None:
+        config = load_config()
+        cache = raw_file_cache.RawFileCache(config['raw_cache_folder'],
+                                            max_size_gb=config['raw_cache_max_gb'])
+        _download_manager = download_tools.DownloadManager(cache=cache)
+    return _download_manager
+
+def close_download_manager():
+    """Stop the download manager threads. A new manager is made the next
+    time download_manager() is called."""
+    global _download_manager
+    if _download_manager is not None:
+        _download_manager.close()
+        _download_manager = None
+
 def download_file(download_path, dest_path, num_attempts=2):
-    for attempt in range(1,num_attempts+1):
-        try:
-            urllib.request.urlretrieve(download_path, dest_path)
-        except:
-            if attempt==num_attempts:
-                return 1
-            else:
-                time.sleep(30)
-                continue
-        return 0
+    manager = download_manager()
+    return manager.download(download_path, dest_path, num_attempts=num_attempts)
 
 def file_available(path):
     try:
@@ -47,42 +72,113 @@ def file_available(path):
 
 def cleanup_tmp_folder(folder):
     for f in os.listdir(folder):
-        os.remove(folder+f)
+        if os.path.isdir(folder+f):
+            shutil.rmtree(folder+f)
+        else:
+            os.remove(folder+f)
 
 def make_folder(f):
     if not os.path.exists(f):
         os.makedirs(f)
 
-def load_config(data_folder=None):
-    with open('config.yaml', 'r') as f:
-        config = yaml.load(f)
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return types.MappingProxyType({k:_freeze(v) for k, v in obj.items()})
+    elif isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    else:
+        return obj
 
-    if data_folder is None:
-        hostname = os.uname().nodename
-        
-        # Check if we're on a hipergator node,
-        # which can have many different prefixes.
-        if 'ufhpc' in hostname:
-            hostname = 'ufhpc'
-        
-        try:
-            data_folder = config['data_folder'][hostname]
-        except KeyError:
-            data_folder = config['data_folder']['default']
+class Config(collections.abc.Mapping):
+    """Read only settings from config.yaml
 
-    config['data_folder'] = data_folder
-    
-    make_folder(data_folder)
+    Entries with 'file' or 'folder' in the name are prefixed with the
+    data folder. Folders are only created the first time they are
+    accessed, and only once per process.
+
+    Use load_config() to get one of these rather than making it directly.
+    """
+    def __init__(self, settings, data_folder):
+        self._settings = _freeze(settings)
+        self._data_folder = data_folder
+        self._created_folders = set()
+        self._lock = threading.Lock()
 
-    for key, value in config.items():
+    def _make_folder_once(self, f):
+        with self._lock:
+            if f not in self._created_folders:
+                make_folder(f)
+                self._created_folders.add(f)
+
+    def __getitem__(self, key):
+        if key == 'data_folder':
+            self._make_folder_once(self._data_folder)
+            return self._data_folder
+
+        value = self._settings[key]
         is_file = 'file' in key
         is_folder = 'folder' in key
-        if (is_file or is_folder) and key != 'data_folder':
-            config[key] = data_folder + value
-        if (is_folder):
-            make_folder(config[key])
+        if is_file or is_folder:
+            value = self._data_folder + value
+        if is_folder:
+            self._make_folder_once(value)
+        return value
+
+    def __iter__(self):
+        return iter(self._settings)
+
+    def __len__(self):
+        return len(self._settings)
+
+    def override(self, **overrides):
+        """A new Config with some settings replaced for this run"""
+        settings = dict(self._settings)
+        settings.update(overrides)
+        return Config(settings, data_folder=self._data_folder)
+
+_config_file_contents = {}
+_loaded_configs = {}
+_config_lock = threading.Lock()
+
+def _read_config_file(config_file):
+    config_file = os.path.abspath(config_file)
+    if config_file not in _config_file_contents:
+        with open(config_file, 'r') as f:
+            _config_file_contents[config_file] = yaml.safe_load(f)
+    return _config_file_contents[config_file]
+
+def _default_data_folder(settings):
+    hostname = os.uname().nodename
     
-    return config
+    # Check if we're on a hipergator node,
+    # which can have many different prefixes.
+    if 'ufhpc' in hostname:
+        hostname = 'ufhpc'
+    
+    try:
+        return settings['data_folder'][hostname]
+    except KeyError:
+        return settings['data_folder']['default']
+
+def load_config(data_folder=None, config_file='config.yaml', **overrides):
+    """Get the settings in config.yaml
+
+    The file is only read once per process, and the same Config object is
+    returned for the same arguments. Keyword arguments override entries
+    in the file, ie. load_config(tmp_folder='tmp/worker_1/')
+    """
+    cache_key = (os.path.abspath(config_file), data_folder, 
+                 repr(sorted(overrides.items())))
+    with _config_lock:
+        if cache_key not in _loaded_configs:
+            settings = dict(_read_config_file(config_file))
+            if data_folder is None:
+                data_folder = _default_data_folder(settings)
+            settings.pop('data_folder')
+            settings.update(overrides)
+            _loaded_configs[cache_key] = Config(settings, data_folder=data_folder)
+    
+        return _loaded_configs[cache_key]
 
 def current_growing_season(config):
     today = datetime.datetime.today()
@@ -93,22 +189,108 @@ def current_growing_season(config):
         year = str(int(year) + 1)
     return year
 
+# Exclusive lock on filename, using a separate .lock file, so several
+# processes can safely write to the same file.
+@contextlib.contextmanager
+def file_lock(filename):
+    with open(filename + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _read_csv_header(filename):
+    with open(filename, 'r', newline='') as f:
+        return next(csv.reader(f), [])
+
+# Write to a temp file next to filename and move it into place, so readers
+# never see a partially written file.
+def _atomic_to_csv(df, filename):
+    tmp_filename = '{f}.{pid}.tmp'.format(f=filename, pid=os.getpid())
+    df.to_csv(tmp_filename, index=False)
+    os.replace(tmp_filename, filename)
+
 # This appends csv's while keeping the header intact
 # or creates a new file if it doesn't already exist.
+# Only the header of the existing file is read, and only the
+# new rows are written.
 def append_csv(df, filename):
-    old_data = pd.read_csv(filename)
-    all_old_columns_in_new = old_data.columns.isin(df.columns).all()
-    all_new_columns_in_old = df.columns.isin(old_data.columns).all()
-    if not all_old_columns_in_new or not all_new_columns_in_old:
-        raise RuntimeError('New dataframe columns do not match old dataframe')
-    
-    appended = old_data.append(df)
-    appended.to_csv(filename, index=False)
+    with file_lock(filename):
+        if not os.path.exists(filename) or os.path.getsize(filename)==0:
+            _atomic_to_csv(df, filename)
+            return
+        
+        old_columns = _read_csv_header(filename)
+        if set(old_columns) != set(df.columns):
+            raise RuntimeError('New dataframe columns do not match old dataframe')
+        
+        # Keep the column order of the existing file
+        new_rows = df[old_columns].to_csv(index=False, header=False)
+        
+        with open(filename, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            missing_newline = f.read(1) not in [b'\n', b'\r']
+        
+        # A single write of all the new rows
+        with open(filename, 'a', newline='') as f:
+            if missing_newline:
+                new_rows = '\n' + new_rows
+            f.write(new_rows)
+            f.flush()
+            os.fsync(f.fileno())
 
 # Re-write a csv with updated info
 def update_csv(df, filename):
-    os.remove(filename)
-    df.to_csv(filename, index=False)
+    with file_lock(filename):
+        _atomic_to_csv(df, filename)
+
+def join_observed(member, observed):
+    """Put the observed days before the start of a forecast-only member
+    in front of it. Forecast only variables are nan for the observed days.
+    """
+    observed = observed.isel(time = observed.time.values < member.time.values[0])
+    all_times = np.concatenate([observed.time.values, member.time.values])
+    
+    joined = {}
+    for varname in member.data_vars:
+        if varname in observed.data_vars:
+            joined[varname] = xr.concat([observed[varname], member[varname]], dim='time')
+        else:
+            joined[varname] = member[varname].reindex(time=all_times)
+    
+    return xr.Dataset(joined, attrs=member.attrs)
+
+def data_folder_relative(filename):
+    """filename relative to the data folder, for storing in files which
+    get copied between hosts. Ones outside the data folder are kept as 
+    absolute paths. See data_folder_path() for the reverse.
+    """
+    filename = os.path.abspath(filename)
+    data_folder = os.path.abspath(load_config()['data_folder'])
+    if os.path.commonpath([filename, data_folder]) != data_folder:
+        return filename
+    return os.path.relpath(filename, data_folder)
+
+def data_folder_path(filename):
+    """The full path of a filename from data_folder_relative()"""
+    return os.path.join(load_config()['data_folder'], filename)
+
+def open_climate_member(filename, chunks=None):
+    """A climate forecast member with the observed season joined to it
+    
+    Members written by cfs_forecasts.get_forecasts_from_date() are only 
+    the forecast, with the observation file (relative to the data folder)
+    in their attributes. All observed days before the start of the 
+    forecast are put in front of it here. Older members which already 
+    have the observations are returned as is.
+    """
+    member = xr.open_dataset(filename, chunks=chunks)
+    if 'observed_file' not in member.attrs:
+        return member
+    
+    observed = xr.open_dataset(data_folder_path(member.attrs['observed_file']), chunks=chunks)
+    return join_observed(member, observed)
 
 def aic(obs, pred, n_param):
     assert isinstance(obs, np.ndarray) and isinstance(pred, np.ndarray), 'obs and pred should be np arrays'
@@ -130,55 +312,224 @@ def read_json(filename):
 
 
 class RemoteRunControl():
+    """Run and monitor the forecast job on the hipergator
+    
+    A single ssh session is kept open and shared by all the remote
+    commands. If it drops it is re-opened, waiting a bit longer after
+    each failed attempt up to wait_time seconds.
+    """
     def __init__(self, con_info, remote_status_filename,
-                 connection_attempts=10, wait_time=60*5):        
+                 connection_attempts=10, wait_time=60*5, keepalive=30):        
         self.con_info = con_info
         self.remote_status_filename = remote_status_filename        
         self.connection_attempts = connection_attempts
         self.wait_time = wait_time
+        self.keepalive = keepalive
+        self.job_id = None
+        
+        self._connection = None
         
         assert connection_attempts>0
 
-    def _remote_command(self, command, attempt=1): 
-        if attempt==self.connection_attempts:
-            print('Cannot connect to server')
-            raise
-        else:
+    def _connect(self):
+        if self._connection is not None and self._connection.is_connected:
+            return self._connection
+        
+        self._disconnect()
+        self._connection = Connection(**self.con_info, connect_kwargs={'banner_timeout':120})
+        self._connection.open()
+        # Keep the session alive thru long waits for the job to finish
+        self._connection.transport.set_keepalive(self.keepalive)
+        return self._connection
+    
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except:
+                pass
+        self._connection = None
+    
+    def close(self):
+        self._disconnect()
+
+    def _remote_command(self, command, hide=False): 
+        for attempt in range(1, self.connection_attempts+1):
             try:
-                with Connection(**self.con_info, connect_kwargs={'banner_timeout':120}) as c:
-                    command_output = c.run(command, warn=True)
-                return command_output
+                c = self._connect()
+                return c.run(command, warn=True, hide=hide)
             except:
                 print('command run failed: "{c}" \n' \
                       'attempt: {x}/{y}'.format(c=command, x=attempt,y=self.connection_attempts))
-                time.sleep(self.wait_time)
-                return self._remote_command(attempt=attempt+1, command=command)
+                self._disconnect()
+                if attempt == self.connection_attempts:
+                    break
+                time.sleep(min(10 * 2**(attempt-1), self.wait_time))
+        
+        raise RuntimeError('Cannot connect to server')
     
     def remote_run_complete(self):
         # If the status file is present then the run is complete. 
         # an error is returned (and ls_output==false) if the file is not present
-        ls_output = self._remote_command('ls ' + self.remote_status_filename)
+        ls_output = self._remote_command('ls ' + self.remote_status_filename, hide=True)
            
         return ls_output.ok
     
     def submit_job(self, remote_job_script):
-        sbatch_output = self._remote_command('sbatch ' + remote_job_script)
+        self.job_id = None
+        sbatch_output = self._remote_command('sbatch --parsable ' + remote_job_script)
+        
+        # --parsable output is "123456", or "123456;cluster" on multi
+        # cluster setups. Without a job id wait_for_completion() only
+        # uses the status file.
+        job_id = sbatch_output.stdout.strip().split(';')[0] if sbatch_output.ok else ''
+        if job_id.isdigit():
+            self.job_id = job_id
+        else:
+            print('could not get slurm job id from sbatch output: ' + repr(sbatch_output.stdout))
     
-    def get_file(self, remote_path, local_path):
-        transfer_succesful = True
-        with Connection(**self.con_info) as c:
+    def job_running(self):
+        """True if the submitted slurm job is still queued or running"""
+        if self.job_id is None:
+            return False
+        squeue_output = self._remote_command('squeue -h -o %T -j ' + self.job_id, hide=True)
+        job_state = squeue_output.stdout.strip()
+        if squeue_output.ok:
+            # Finished jobs are listed with their final state (COMPLETED,
+            # FAILED, etc.) for a few minutes, then not at all.
+            return job_state in ['PENDING','CONFIGURING','RUNNING','COMPLETING']
+        if 'Invalid job id' in squeue_output.stderr:
+            # The job has left slurm entirely
+            return False
+        # Anything else (slurmctld busy, timeouts) says nothing about the
+        # job, so assume it's still going and check again next time.
+        print('squeue failed for job {j}: {e}'.format(j=self.job_id, e=squeue_output.stderr.strip()))
+        return True
+    
+    def wait_for_completion(self, timeout=None, block_time=60*5, check_interval=2):
+        """Wait for the remote status file to show up
+        
+        The wait happens on the remote side, which checks for the file every 
+        check_interval seconds for up to block_time seconds per command. So
+        this returns within a few seconds of the run finishing. 
+        
+        If the slurm job ends without writing the status file a
+        RuntimeError is raised. Returns False if timeout (in seconds)
+        is reached, True otherwise.
+        """
+        start_time = time.time()
+        status_file = shlex.quote(self.remote_status_filename)
+        wait_command = 'for i in $(seq {n}); do [ -e {f} ] && exit 0; sleep {s}; done; exit 1'.format(n=max(int(block_time/check_interval),1),
+                                                                                                         f=status_file,
+                                                                                                         s=check_interval)
+        while timeout is None or time.time() - start_time < timeout:
+            if self._remote_command(wait_command, hide=True).ok:
+                return True
+            
+            if self.job_id is not None and not self.job_running():
+                # The job may have finished between the two commands
+                if self.remote_run_complete():
+                    return True
+                raise RuntimeError('remote job {j} ended without writing the status file'.format(j=self.job_id))
+        
+        return False
+    
+    def _remote_bytes(self, command):
+        # The raw stdout of a remote command. c.run() decodes output as
+        # text so this goes thru the underlying paramiko client instead.
+        for attempt in range(1, self.connection_attempts+1):
             try:
-                c.get(remote = remote_path, local = local_path)
+                c = self._connect()
+                stdin, stdout, stderr = c.client.exec_command(command)
+                data = stdout.read()
+                if stdout.channel.recv_exit_status() != 0:
+                    raise IOError('remote command failed: ' + command)
+                return data
             except:
-                raise RuntimeWarning('could  not transfer file: ' + remote_path)
-                transfer_succesful = False
+                print('command run failed: "{c}" \n' \
+                      'attempt: {x}/{y}'.format(c=command, x=attempt,y=self.connection_attempts))
+                self._disconnect()
+                if attempt == self.connection_attempts:
+                    break
+                time.sleep(min(10 * 2**(attempt-1), self.wait_time))
+        
+        raise RuntimeError('Cannot run command on server: ' + command)
+    
+    def _get_file_chunked(self, remote_path, local_path, expected_sha256,
+                          chunk_size, compression_level):
+        remote_file = shlex.quote(remote_path)
+        remote_size = int(self._remote_bytes('stat -c %s ' + remote_file).decode().strip())
+        
+        if expected_sha256 is None:
+            sha256sum_output = self._remote_bytes('sha256sum ' + remote_file).decode()
+            expected_sha256 = sha256sum_output.split()[0]
+        
+        # Pick up from the last complete chunk of an earlier attempt
+        part_path = local_path + '.part'
+        if os.path.exists(part_path):
+            completed_chunks = os.path.getsize(part_path) // chunk_size
+        else:
+            completed_chunks = 0
+        
+        with open(part_path, 'ab') as f:
+            f.truncate(completed_chunks * chunk_size)
+            
+            num_chunks = int(np.ceil(remote_size / chunk_size))
+            for chunk_i in range(completed_chunks, num_chunks):
+                chunk_command = 'dd if={f} bs={bs} skip={i} count=1 iflag=fullblock 2>/dev/null | gzip -{l} -c'.format(f=remote_file,
+                                                                                                                     bs=chunk_size,
+                                                                                                                     i=chunk_i,
+                                                                                                                     l=compression_level)
+                chunk = gzip.decompress(self._remote_bytes(chunk_command))
+                
+                expected_chunk_size = min(chunk_size, remote_size - chunk_i*chunk_size)
+                if len(chunk) != expected_chunk_size:
+                    raise IOError('chunk {i} is {s} bytes, expected {e}'.format(i=chunk_i, s=len(chunk), e=expected_chunk_size))
+                
+                f.write(chunk)
+                f.flush()
+        
+        if raw_file_cache.file_sha256(part_path) != expected_sha256:
+            os.remove(part_path)
+            raise IOError('checksum mismatch for ' + remote_path)
+        
+        os.replace(part_path, local_path)
+    
+    def get_file(self, remote_path, local_path, mode='chunked', expected_sha256=None,
+                 chunk_size=64*1024**2, compression_level=1):
+        """Copy a file from the remote server
+        
+        mode
+            'chunked': the file is sent in gzip compressed chunks. An 
+                       interrupted transfer is resumed from the last complete
+                       chunk, and the final file is verified against
+                       expected_sha256 (or the sha256 of the remote file
+                       if that is None).
+            'sftp': a single sftp get with no resuming or verification.
+        
+        Returns True if the transfer was successful, False otherwise.
+        """
+        assert mode in ['chunked','sftp'], 'unknown transfer mode: ' + str(mode)
+        
+        transfer_succesful = True
+        try:
+            if mode == 'chunked':
+                self._get_file_chunked(remote_path, local_path, 
+                                       expected_sha256 = expected_sha256,
+                                       chunk_size = chunk_size,
+                                       compression_level = compression_level)
+            else:
+                self._connect().get(remote = remote_path, local = local_path)
+        except:
+            print('could  not transfer file: ' + remote_path)
+            transfer_succesful = False
         
         return transfer_succesful
             
             
     def remote_run_info(self):
         # Get the remote status file as a dictionary.
-        cat_output = self._remote_command('cat ' + self.remote_status_filename)
+        cat_output = self._remote_command('cat ' + self.remote_status_filename, hide=True)
             
         if cat_output.ok:
             return json.loads(cat_output.stdout)
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+
+# Lightweight timing of the pipeline stages. Spans can be nested and each
+# one records wall time, cpu time, and bytes read/written by the process
+# while it was open. Finished spans are written as json lines to the trace
+# file (if set) and can be summarized for run_info.json.
+#
+#   with tracing.span('spatial_downscale', initial_time='2018021518'):
+#       ...
+#
+#   @tracing.traced('prism_download')
+#   def download_days(...):
+#
+# Spans from worker processes or threads are collected there with
+# collect(), passed back, and recorded under the submitting span with
+# add_records().
+#
+# Work from one stage which happens inside another (ie. a generator of
+# climate members consumed by the phenology models) goes in a
+# separate_span(), which is top level and whose time is not counted in
+# the spans around it.
+
+_finished_spans = []
+_span_lock = threading.Lock()
+_local = threading.local()
+_trace_file = None
+_span_counter = 0
+_measures = ['wall_sec','cpu_sec','bytes_read','bytes_written']
+
+def set_trace_file(filename):
+    """Append finished spans to filename as json lines"""
+    global _trace_file
+    _trace_file = filename
+
+def reset():
+    global _finished_spans
+    with _span_lock:
+        _finished_spans = []
+
+# Bytes read and written by this process, including network i/o. Only
+# available on linux, elsewhere these are always 0.
+def _io_counters():
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, KeyError, ValueError):
+        return 0, 0
+
+def _record(record):
+    with _span_lock:
+        _finished_spans.append(record)
+    _emit(record)
+
+def _span_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _emit(record):
+    if _trace_file is None:
+        return
+    with _span_lock:
+        with open(_trace_file, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    global _span_counter
+    stack = _span_stack()
+    with _span_lock:
+        _span_counter += 1
+        span_id = _span_counter
+
+    if len(stack) > 0:
+        parent = stack[-1]
+        path = parent['path'] + '/' + name
+        parent_id = parent['id']
+    else:
+        path = name
+        parent_id = None
+
+    record = {'name':name,
+              'path':path,
+              'id':span_id,
+              'parent':parent_id,
+              'pid':os.getpid(),
+              'attributes':attributes,
+              'start':time.time()}
+    stack.append(record)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    read_start, write_start = _io_counters()
+    status = 'ok'
+    try:
+        yield record
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        read_end, write_end = _io_counters()
+        excluded = record.pop('_excluded', {})
+        record['wall_sec'] = round(time.perf_counter() - wall_start - excluded.get('wall_sec', 0), 3)
+        record['cpu_sec'] = round(time.process_time() - cpu_start - excluded.get('cpu_sec', 0), 3)
+        record['bytes_read'] = read_end - read_start - excluded.get('bytes_read', 0)
+        record['bytes_written'] = write_end - write_start - excluded.get('bytes_written', 0)
+        record['status'] = status
+        stack.pop()
+
+        if getattr(_local, 'collected', None) is not None:
+            _local.collected.append(record)
+        else:
+            _record(record)
+
+@contextlib.contextmanager
+def separate_span(name, **attributes):
+    """A top level span, even when other spans are open in this thread. 
+    Its time is taken out of those open spans when they finish.
+    """
+    outer_stack = _span_stack()
+    _local.stack = []
+    record = None
+    try:
+        with span(name, **attributes) as record:
+            yield record
+    finally:
+        _local.stack = outer_stack
+        if record is not None:
+            for open_record in outer_stack:
+                excluded = open_record.setdefault('_excluded', {})
+                for measure in _measures:
+                    excluded[measure] = excluded.get(measure, 0) + record[measure]
+
+def current_span():
+    """The innermost open span in this thread, or None"""
+    stack = _span_stack()
+    return stack[-1] if len(stack) > 0 else None
+
+@contextlib.contextmanager
+def collect():
+    """Spans finished in this thread while open are put in the yielded 
+    list instead of being recorded. The list can be returned from a worker
+    and recorded in the main process with add_records().
+    
+    Collected spans start from the top level. Forked workers have a copy 
+    of the spans open in the main process when they were started, and 
+    those are not their parents.
+    """
+    outer_stack = _span_stack()
+    _local.stack = []
+    _local.collected = []
+    try:
+        yield _local.collected
+    finally:
+        _local.collected = None
+        _local.stack = outer_stack
+
+def add_records(records, parent=None):
+    """Record spans from collect(). Top level ones are put under parent, a
+    span from current_span(), and all of them get new ids.
+    """
+    global _span_counter
+    new_ids = {}
+    with _span_lock:
+        for record in records:
+            _span_counter += 1
+            new_ids[record['id']] = _span_counter
+
+    for record in records:
+        record = dict(record)
+        record['id'] = new_ids[record['id']]
+        if record['parent'] in new_ids:
+            record['parent'] = new_ids[record['parent']]
+        elif parent is not None:
+            record['parent'] = parent['id']
+        if parent is not None:
+            record['path'] = parent['path'] + '/' + record['path']
+        _record(record)
+
+def traced(name=None):
+    """Decorator version of span(). The name defaults to the function name"""
+    def decorator(f):
+        span_name = name or f.__name__
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def summary():
+    """Totals for each span path, for including in run_info.json"""
+    totals = {}
+    with _span_lock:
+        spans = list(_finished_spans)
+
+    for record in spans:
+        path_total = totals.setdefault(record['path'], {'count':0,
+                                                        'errors':0,
+                                                        'wall_sec':0,
+                                                        'cpu_sec':0,
+                                                        'bytes_read':0,
+                                                        'bytes_written':0})
+        path_total['count'] += 1
+        path_total['errors'] += record['status'] == 'error'
+        for key in _measures:
+            path_total[key] += record[key]
+
+    for path_total in totals.values():
+        path_total['wall_sec'] = round(path_total['wall_sec'], 3)
+        path_total['cpu_sec'] = round(path_total['cpu_sec'], 3)
+
+    return totals